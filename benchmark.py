@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# times upgrayedd.py and runner.py end to end against farms (see farm.py)
+# of a few sizes, and compares the times with a saved baseline
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fakegithub import FakeGithub
+from farm import Farm, GIT_ENV
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RUNNER = os.path.join(HERE, 'runner.py')
+UPGRAYEDD = os.path.join(HERE, 'upgrayedd.py')
+
+
+def runner(farm, options, *mode):
+    return [sys.executable, RUNNER, '--base', farm.base,
+            '--repos', farm.repos] + list(mode) + options
+
+
+def upgrayedd(farm, options, *mode):
+    return [sys.executable, UPGRAYEDD, '--base', farm.base,
+            '--repos', farm.repos, '--hub', farm.hub] + list(mode) + options
+
+
+# name -> argv for the run, in the order they're run. each round leaves
+# the farm fit for the next.
+SCENARIOS = [
+    ('clone', lambda farm, options, sandbox, rnd: [
+        sys.executable, RUNNER, '--base', sandbox, '--repos', farm.repos,
+        '--clone', '--remote', farm.remote()] + options),
+    ('status', lambda farm, options, sandbox, rnd: runner(
+        farm, options, '--status')),
+    ('checkout', lambda farm, options, sandbox, rnd: runner(
+        farm, options, '--checkout', 'master')),
+    ('make', lambda farm, options, sandbox, rnd: runner(
+        farm, options, '--make')),
+    ('new_branch', lambda farm, options, sandbox, rnd: runner(
+        farm, options, '--new_branch', 'runner-%d' % rnd)),
+    # a change every repo has, for the commit to push
+    ('requirements', lambda farm, options, sandbox, rnd: runner(
+        farm, options, '--match', r'^(Django==\S+)$',
+        '--replace', '$1  # runner-%d' % rnd)),
+    ('commit', lambda farm, options, sandbox, rnd: runner(
+        farm, options, '--commit', 'runner-%d' % rnd,
+        '--message', 'benchmark')),
+    ('publish', lambda farm, options, sandbox, rnd: runner(
+        farm, options, '--publish')),
+    ('upgrade', lambda farm, options, sandbox, rnd: upgrayedd(
+        farm, options, '--branch', 'bench-%d' % rnd,
+        '--match', 'Django==2.2.12', '--replace', 'Django==2.2.13')),
+    ('uworld', lambda farm, options, sandbox, rnd: upgrayedd(
+        farm, options, '--uworld', '1')),
+    ('mworld', lambda farm, options, sandbox, rnd: upgrayedd(
+        farm, options, '--mworld', '1')),
+]
+
+# runs of the merge task against a FakeGithub: name -> extra options
+MERGE_BRANCH = 'bench-merge'
+MERGE_SCENARIOS = [
+    ('merge', lambda cache: []),
+    ('merge-batch', lambda cache: ['--batch']),
+    # the second of two runs sharing an ETag cache
+    ('merge-cached', lambda cache: ['--cache', cache]),
+]
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=HERE,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def timed(cmd, log):
+    started = time.monotonic()
+    # commits are made as the farm's user, whoever's running this
+    ret = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT,
+                          env=dict(os.environ, **GIT_ENV))
+    return (time.monotonic() - started, ret)
+
+
+def bench_size(work, size, names, args, results, calls):
+    farm = Farm(os.path.join(work, str(size)))
+    print('making a farm of %d repos' % size)
+    farm.create(size, args.sleep, args.cpu, args.fail, args.hub_latency,
+                args.seed)
+    options = ['--jobs', str(args.jobs)]
+    log = open(os.path.join(work, '%d.log' % size), 'w')
+    for rnd in range(args.rounds):
+        sandbox = os.path.join(farm.path, 'sandbox')
+        if os.path.exists(sandbox):
+            shutil.rmtree(sandbox)
+        os.makedirs(sandbox)
+        for (name, argv) in SCENARIOS:
+            if name not in names:
+                continue
+            (seconds, ret) = timed(argv(farm, options, sandbox, rnd), log)
+            print('%-12s %6d repos %9.2fs%s' % (
+                name, size, seconds, '' if not ret else ' (exit %d)' % ret))
+            # the best of the rounds
+            best = results.setdefault(name, {}).get(str(size))
+            if best is None or seconds < best:
+                results[name][str(size)] = seconds
+        bench_merges(farm, size, names, args, results, calls, log)
+    log.close()
+
+
+def bench_merges(farm, size, names, args, results, calls, log):
+    scenarios = [(name, extra) for (name, extra) in MERGE_SCENARIOS
+                 if name in names]
+    if not scenarios:
+        return
+    github = FakeGithub(
+        'ccnmtl', farm.names(), MERGE_BRANCH, args.api_latency,
+        failure_rate=args.api_failure_rate, rate_limit=args.api_rate_limit,
+        rate_window=1, pulls=args.pulls, seed=args.seed)
+    github.start()
+    cache = os.path.join(farm.path, 'etags')
+    try:
+        for (name, extra) in scenarios:
+            cmd = [sys.executable, RUNNER, '--base', farm.base,
+                   '--repos', farm.repos, '--owner', 'ccnmtl',
+                   '--match', MERGE_BRANCH, '--api_token', 'bench',
+                   '--api_base', github.url(),
+                   '--jobs', str(args.jobs)] + extra(cache)
+            if name == 'merge-cached':
+                github.reset()
+                timed(cmd, log)
+            github.reset()
+            (seconds, ret) = timed(cmd, log)
+            counted = dict(github.calls, billed=github.billed,
+                           connections=len(github.connections))
+            print('%-12s %6d repos %9.2fs %7.1f repos/s %6d calls '
+                  '(%d billed) %4d connections' % (
+                      name, size, seconds, size / seconds,
+                      sum(github.calls.values()), github.billed,
+                      len(github.connections)))
+            best = results.setdefault(name, {}).get(str(size))
+            if best is None or seconds < best:
+                results[name][str(size)] = seconds
+                calls.setdefault(name, {})[str(size)] = counted
+    finally:
+        github.stop()
+
+
+def compare(results, baseline, tolerance):
+    # prints each time against the baseline's; the regressions
+    regressions = []
+    print('%-12s %6s %10s %10s %8s' % (
+        'scenario', 'repos', 'seconds', 'baseline', 'change'))
+    for (name, sizes) in results.items():
+        for (size, seconds) in sizes.items():
+            before = baseline.get(name, {}).get(size)
+            if not before:
+                print('%-12s %6s %9.2fs %10s' % (name, size, seconds, '-'))
+                continue
+            change = seconds / before - 1
+            flag = ''
+            if change > tolerance:
+                flag = ' REGRESSION'
+                regressions.append((name, size))
+            print('%-12s %6s %9.2fs %9.2fs %+7.0f%%%s' % (
+                name, size, seconds, before, change * 100, flag))
+    return regressions
+
+
+def main(args):
+    names = args.scenarios.split(',') if args.scenarios else [
+        name for (name, argv) in SCENARIOS + MERGE_SCENARIOS]
+    sizes = [int(s) for s in args.sizes.split(',')]
+    work = args.work or tempfile.mkdtemp(prefix='upgrayedd-bench-')
+    results = {}
+    calls = {}
+    try:
+        for size in sizes:
+            bench_size(work, size, names, args, results, calls)
+    finally:
+        if not args.work:
+            shutil.rmtree(work)
+
+    document = {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.time(),
+        'options': {'jobs': args.jobs, 'rounds': args.rounds,
+                    'sleep': args.sleep, 'cpu': args.cpu, 'fail': args.fail,
+                    'hub_latency': args.hub_latency, 'seed': args.seed,
+                    'api_latency': args.api_latency,
+                    'api_failure_rate': args.api_failure_rate,
+                    'api_rate_limit': args.api_rate_limit,
+                    'pulls': args.pulls},
+        'results': results,
+        'api_calls': calls,
+    }
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    if compare(results, baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='benchmark upgrayedd.py and runner.py on local repos')
+    parser.add_argument('--sizes', default='10,100',
+                        help='comma separated numbers of repos, '
+                        'eg. 10,100,1000')
+    parser.add_argument('--scenarios',
+                        help='comma separated, out of: %s' % ', '.join(
+                            name for (name, argv) in
+                            SCENARIOS + MERGE_SCENARIOS))
+    parser.add_argument('--jobs', type=int, default=8,
+                        help='--jobs for each run')
+    parser.add_argument('--rounds', type=int, default=1,
+                        help='times to run each scenario, keeping the best')
+    parser.add_argument('--sleep', type=float, default=0.0,
+                        help='seconds each `make` sleeps for')
+    parser.add_argument('--cpu', type=int, default=0,
+                        help='size of the sum each `make` works out')
+    parser.add_argument('--fail', type=float, default=0.0,
+                        help='fraction of repos whose `make` fails')
+    parser.add_argument('--hub-latency', type=float, default=0.0,
+                        help='seconds the fake hub takes per pull request')
+    parser.add_argument('--api-latency', type=float, default=0.05,
+                        help='seconds the fake Github API takes over each '
+                        'request')
+    parser.add_argument('--api-failure-rate', type=float, default=0.0,
+                        help='fraction of API requests that get a 502')
+    parser.add_argument('--api-rate-limit', type=int,
+                        help='API requests allowed per second')
+    parser.add_argument('--pulls', type=int, default=0,
+                        help='other open pull requests in each repo')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work',
+                        help='directory for the farms and run logs, '
+                        'kept afterwards (default: a temporary one)')
+    parser.add_argument('--save', help='file to save the results to')
+    parser.add_argument('--baseline',
+                        help='results saved earlier to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slow down, as a fraction of the baseline, '
+                        'that counts as a regression')
+    main(parser.parse_args())
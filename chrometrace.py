@@ -0,0 +1,68 @@
+import json
+import os
+import threading
+import time
+
+
+def microseconds(t):
+    return int(t * 1000000)
+
+
+class ChromeTrace(object):
+    # the run as Chrome trace events, for chrome://tracing or
+    # ui.perfetto.dev: a track per worker, with a span for each repo the
+    # worker had and, inside it, one per step. a worker is one of the
+    # --jobs slots; a repo gets the lowest numbered one free when it
+    # starts.
+
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self.workers = 0
+        self.free = []
+        self.running = {}
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def worker(self):
+        if self.free:
+            self.free.sort()
+            return self.free.pop(0)
+        self.workers += 1
+        self.events.append({
+            'ph': 'M', 'name': 'thread_name', 'pid': self.pid,
+            'tid': self.workers, 'args': {'name': 'worker %d' % self.workers}})
+        return self.workers
+
+    def started(self, task):
+        with self.lock:
+            self.running[id(task)] = (self.worker(), time.time())
+
+    def span(self, name, category, worker, started, wall, args):
+        return {'ph': 'X', 'name': name, 'cat': category, 'pid': self.pid,
+                'tid': worker, 'ts': microseconds(started),
+                'dur': microseconds(wall), 'args': args}
+
+    def finished(self, task):
+        with self.lock:
+            (worker, started) = self.running.pop(id(task))
+        spans = [self.span(
+            task.repo, 'repo', worker, started, time.time() - started,
+            {'status': task.status, 'log': task.log})]
+        for t in task.timings:
+            if t.started < started:
+                continue
+            spans.append(self.span(
+                t.label, t.resource or 'step', worker, t.started, t.wall,
+                {'repo': task.repo, 'cmd': t.cmd,
+                 'returncode': t.returncode, 'user': t.user,
+                 'sys': t.sys}))
+        with self.lock:
+            self.events.extend(spans)
+            self.free.append(worker)
+
+    def close(self):
+        with self.lock:
+            events = list(self.events)
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,399 @@
+import asyncio
+import contextvars
+import fcntl
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+# something with an add_rusage(), eg. a timing.StepTiming, that's given
+# the rusage of each child `call` reaps while it's set
+children = contextvars.ContextVar('children', default=None)
+# something with feed(bytes), eg. a logs.StepOutput, that the output of
+# each child `call` starts while it's set goes to instead of our stdout.
+# if its splice_target() gives a file descriptor, the output is spliced
+# straight into that instead, without passing through python.
+sink = contextvars.ContextVar('sink', default=None)
+# whether no one can be expected to answer the children `call` starts
+# while it's set: several are running at once, or any of them can be cut
+# off (see popen). gather_bounded sets it for what it runs side by side.
+unattended = contextvars.ContextVar('unattended', default=False)
+
+# the most bytes spliced in one go, and the most goes before letting the
+# event loop get on with something else
+SPLICE_SIZE = 1024 * 1024
+SPLICE_ROUNDS = 16
+# what captured output pipes are grown to, where that can be done; the
+# default most systems allow unprivileged processes
+PIPE_SIZE = 1024 * 1024
+# seconds a cancelled child's process group gets to exit after SIGTERM,
+# before it's sent SIGKILL
+GRACE = 5
+
+
+def run_sync(coro):
+    # the synchronous API (Step.run, Task.make, ...) is a thin wrapper
+    # around the async one.
+    #
+    # a first Ctrl-C cancels coro, which kills the children in flight (see
+    # call) and lets the tasks record themselves as cancelled; a second
+    # one is a KeyboardInterrupt as usual
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    main = loop.create_task(coro)
+
+    def interrupted():
+        loop.remove_signal_handler(signal.SIGINT)
+        print('interrupted, stopping everything in flight')
+        main.cancel()
+
+    try:
+        loop.add_signal_handler(signal.SIGINT, interrupted)
+    except (ValueError, RuntimeError, NotImplementedError):
+        # not the main thread, or not somewhere with signals
+        pass
+    try:
+        return loop.run_until_complete(main)
+    except asyncio.CancelledError:
+        raise KeyboardInterrupt
+    finally:
+        try:
+            loop.remove_signal_handler(signal.SIGINT)
+        except (ValueError, RuntimeError, NotImplementedError):
+            pass
+        cancel_pending(loop)
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def cancel_pending(loop):
+    # whatever coro left running when it gave up, eg. on an exception or
+    # a second Ctrl-C, is cancelled and waited for, so that every call()
+    # in flight kills and reaps its children
+    pending = asyncio.all_tasks(loop)
+    for task in pending:
+        task.cancel()
+    if pending:
+        loop.run_until_complete(
+            asyncio.gather(*pending, return_exceptions=True))
+
+
+def note(message):
+    # a line of our own about the step in flight: with its commands'
+    # output when that's captured (see sink), otherwise to stdout
+    out = sink.get()
+    if out is None:
+        print(message)
+    else:
+        out.feed((message + '\n').encode())
+
+
+async def gather_bounded(coros, limit=1):
+    # results come back in the same order as coros
+    semaphore = asyncio.Semaphore(max(limit, 1))
+
+    async def bounded(coro):
+        # when the gather is cancelled, it still waits for every coro to
+        # wind down (eg. kill its children) before raising CancelledError
+        if limit > 1:
+            unattended.set(True)
+        try:
+            async with semaphore:
+                return await coro
+        except asyncio.CancelledError:
+            return None
+        finally:
+            # cancelled before its turn came
+            coro.close()
+
+    return await asyncio.gather(*[bounded(c) for c in coros])
+
+
+async def call(cmd, cwd=None, env=None):
+    """asyncio counterpart of subprocess.call()"""
+    out = sink.get()
+    pipes = {}
+    if out is not None:
+        pipes = {'stdout': subprocess.PIPE, 'stderr': subprocess.STDOUT}
+    try:
+        proc = popen(cmd, cwd=cwd, env=env, **pipes)
+    except OSError as e:
+        return not_started(cmd, e)
+    try:
+        if out is None:
+            (returncode, rusage) = await reap(proc)
+        else:
+            (returncode, rusage) = await capture(proc, out)
+    except asyncio.CancelledError:
+        # timed out or interrupted: nothing it started is left running
+        await terminate(proc)
+        raise
+    usage = children.get()
+    if usage is not None:
+        usage.add_rusage(rusage)
+    return returncode
+
+
+def not_started(cmd, e):
+    # eg. no such program or cwd: like a shell, that's this step failing,
+    # not everything else in flight
+    message = '%s: %s\n' % (cmd[0], e.strerror or e)
+    out = sink.get()
+    if out is not None:
+        out.feed(message.encode())
+    else:
+        sys.stderr.write(message)
+    return 127
+
+
+def popen(cmd, env=None, **kwargs):
+    # attended, a child is started like any other command, so it can ask
+    # at the terminal for eg. an ssh key's passphrase.
+    #
+    # unattended, it's in a process group of its own, so that it and
+    # everything it starts can be killed together (see terminate). that
+    # also keeps a Ctrl-C at the terminal from reaching it; run_sync sees
+    # to it instead. a background process group that reads the terminal
+    # is stopped, so nothing gets to: stdin is /dev/null, and git and ssh
+    # are told to fail rather than ask for credentials, a passphrase or a
+    # host key.
+    if not unattended.get():
+        proc = subprocess.Popen(cmd, env=env, **kwargs)
+        proc.group = False
+        return proc
+    env = dict(os.environ if env is None else env)
+    env['GIT_TERMINAL_PROMPT'] = '0'
+    if 'GIT_SSH_COMMAND' not in env and 'GIT_SSH' not in env:
+        env['GIT_SSH_COMMAND'] = 'ssh -o BatchMode=yes'
+    kwargs['env'] = env
+    kwargs['stdin'] = subprocess.DEVNULL
+    if sys.version_info >= (3, 11):
+        kwargs['process_group'] = 0
+    else:
+        kwargs['preexec_fn'] = os.setpgrp
+    proc = subprocess.Popen(cmd, **kwargs)
+    proc.group = True
+    return proc
+
+
+def reaped(proc):
+    # whether a Popen has been waited for, waiting for it if it's exited
+    if proc.returncode is not None:
+        return True
+    try:
+        (pid, status) = os.waitpid(proc.pid, os.WNOHANG)
+    except ChildProcessError:
+        # by someone else, eg. a wait4_in_thread
+        return True
+    if pid:
+        proc.returncode = exit_code(status)
+    return bool(pid)
+
+
+def group_alive(pgid):
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def signal_group(pgid, sig):
+    try:
+        os.killpg(pgid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def signal_child(proc, sig):
+    # the Popen's process group, if popen gave it one, else just it
+    if proc.group:
+        signal_group(proc.pid, sig)
+    elif proc.returncode is None:
+        try:
+            os.kill(proc.pid, sig)
+        except ProcessLookupError:
+            pass
+
+
+async def terminate(proc, grace=GRACE):
+    # kills a Popen with SIGTERM, then after grace seconds SIGKILL for
+    # whatever is left of its process group (if it has one), whether or
+    # not the child itself has gone, and reaps the child
+    signal_child(proc, signal.SIGTERM)
+    deadline = time.monotonic() + grace
+    while time.monotonic() < deadline:
+        if reaped(proc) and not (proc.group and group_alive(proc.pid)):
+            return
+        await asyncio.sleep(0.05)
+    signal_child(proc, signal.SIGKILL)
+    deadline = time.monotonic() + grace
+    while not reaped(proc) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+
+class Pump(asyncio.Protocol):
+    # hands what comes down a pipe to a sink
+
+    def __init__(self, out, loop):
+        self.out = out
+        self.closed = loop.create_future()
+
+    def data_received(self, data):
+        self.out.feed(data)
+
+    def connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+
+def widen_pipe(f):
+    # fewer, bigger wakeups for a chatty child
+    if not hasattr(fcntl, 'F_SETPIPE_SZ'):
+        return
+    try:
+        fcntl.fcntl(f.fileno(), fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+    except OSError:
+        pass
+
+
+async def capture(proc, out):
+    # reap(), feeding the Popen's stdout to out as it comes
+    widen_pipe(proc.stdout)
+    target = out.splice_target() if hasattr(os, 'splice') else None
+    if target is not None:
+        return await splice_into(proc, target)
+    loop = asyncio.get_event_loop()
+    pump = Pump(out, loop)
+    (transport, _) = await loop.connect_read_pipe(lambda: pump, proc.stdout)
+    try:
+        result = await reap(proc)
+        await pump.closed
+    finally:
+        transport.close()
+    return result
+
+
+def splice_ready(src, dst, closed):
+    # moves what's waiting in the pipe src to dst in the kernel, until
+    # the pipe is closed
+    try:
+        for _ in range(SPLICE_ROUNDS):
+            if not os.splice(src, dst, SPLICE_SIZE,
+                             flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK):
+                closed.set_result(None)
+                break
+    except BlockingIOError:
+        pass
+    except OSError as e:
+        closed.set_exception(e)
+    if closed.done():
+        asyncio.get_event_loop().remove_reader(src)
+
+
+async def splice_into(proc, dst):
+    # reap(), splicing the Popen's stdout into the file descriptor dst
+    loop = asyncio.get_event_loop()
+    src = proc.stdout.fileno()
+    os.set_blocking(src, False)
+    closed = loop.create_future()
+    loop.add_reader(src, splice_ready, src, dst, closed)
+    try:
+        result = await reap(proc)
+        await closed
+    finally:
+        loop.remove_reader(src)
+        proc.stdout.close()
+    return result
+
+
+def exit_code(status):
+    # a wait() status as a Popen.returncode
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def wait4_in_thread(pid):
+    # where there's no pidfd_open (before linux 5.3 or python 3.9, or
+    # not on linux at all): a thread of its own, rather than a pool's, so
+    # that a long build can't hold up noticing that other children have
+    # exited. that's a thread per child running, as many as --jobs, which
+    # is what asyncio's own ThreadedChildWatcher does too. one SIGCHLD
+    # handler for all of them would replace the one asyncio's child
+    # watcher installs on older pythons for output(), and wait4(-1) would
+    # reap subprocess's children from under it.
+    loop = asyncio.get_event_loop()
+    exited = loop.create_future()
+
+    def wait():
+        result = os.wait4(pid, 0)
+        loop.call_soon_threadsafe(exited.set_result, result)
+
+    threading.Thread(target=wait, daemon=True).start()
+    return exited
+
+
+async def reap(proc):
+    # waits for a Popen with wait4(), the only way to get the rusage of
+    # just that one child: (returncode, rusage)
+    if not hasattr(os, 'pidfd_open'):
+        (_, status, rusage) = await wait4_in_thread(proc.pid)
+    else:
+        loop = asyncio.get_event_loop()
+        fd = os.pidfd_open(proc.pid)
+        exited = loop.create_future()
+        loop.add_reader(
+            fd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+        (_, status, rusage) = os.wait4(proc.pid, 0)
+    proc.returncode = exit_code(status)
+    return (proc.returncode, rusage)
+
+
+async def output(cmd, cwd=None, env=None):
+    # like subprocess.run(stdout=PIPE): (returncode, stdout bytes)
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, cwd=cwd, env=env, stdout=asyncio.subprocess.PIPE)
+    except OSError as e:
+        return (not_started(cmd, e), b'')
+    (out, _) = await proc.communicate()
+    return (proc.returncode, out)
+
+
+async def in_thread(func, *args, executor=None):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, func, *args)
+
+
+class Unbounded(object):
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class Lanes(object):
+    # one bounded pool per resource class (see steps.classify), so that
+    # eg. one repo's `git pull` can go ahead while another is in `make`.
+    # classes without a limit are not throttled at all.
+
+    def __init__(self, limits=None):
+        self.limits = limits or {}
+        self.semaphores = {}
+
+    def lane(self, resource):
+        limit = self.limits.get(resource)
+        if not limit:
+            return Unbounded()
+        if resource not in self.semaphores:
+            self.semaphores[resource] = asyncio.Semaphore(limit)
+        return self.semaphores[resource]
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# a stand-in for the bits of the Github API that the merge task uses (see
+# steps.py and github.py), to run it offline: the commit status,
+# pull request list and merge REST calls and the batched GraphQL
+# lookup. latency, pagination, failures and the rate limit can all be
+# dialed in, and every call is counted.
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlencode, urlparse
+
+# matched at the end of the path, so that the API can be under a prefix
+# like github enterprise's /api/v3
+STATUS = re.compile(r'/repos/([^/]+)/([^/]+)/commits/([^/]+)/status$')
+PULLS = re.compile(r'/repos/([^/]+)/([^/]+)/pulls$')
+MERGE = re.compile(r'/repos/([^/]+)/([^/]+)/pulls/(\d+)/merge$')
+
+# a status pyup sets on everything, which the merge should ignore
+PYUP = {'context': 'pyup.io/safety-ci', 'state': 'failure'}
+
+
+def sha(*parts):
+    return hashlib.sha1('/'.join(parts).encode()).hexdigest()
+
+
+class FakeGithub(object):
+    # each repo has `pulls` unrelated open pull requests, then one for
+    # `branch`. a `failing` fraction of those have a failing CI status
+    # and a `conflicting` fraction can't be merged.
+
+    def __init__(self, owner, repos, branch, latency=0.0, per_page=30,
+                 failure_rate=0.0, rate_limit=None, rate_window=60,
+                 pulls=0, failing=0.0, conflicting=0.0, seed=0):
+        self.owner = owner
+        self.repos = list(repos)
+        self.branch = branch
+        self.latency = latency
+        self.per_page = per_page
+        self.failure_rate = failure_rate
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.pull_count = pulls
+        self.failing = failing
+        self.conflicting = conflicting
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.server = None
+        self.reset()
+
+    def reset(self):
+        # back to every pull request open, with no calls counted
+        rng = random.Random(self.seed)
+        self.failures = random.Random(self.seed)
+        self.pulls = {}
+        for r in self.repos:
+            prs = [self.pull(r, n + 1, 'other-%d' % n, False, False)
+                   for n in range(self.pull_count)]
+            prs.append(self.pull(
+                r, self.pull_count + 1, self.branch,
+                rng.random() < self.failing,
+                rng.random() < self.conflicting))
+            self.pulls[r] = prs
+        self.calls = Counter()
+        self.connections = set()
+        self.window = 0
+        self.used = 0
+        # requests that count against the rate limit, in all
+        self.billed = 0
+
+    def pull(self, repo, number, ref, failing, conflicting):
+        return {'number': number, 'ref': ref, 'sha': sha(repo, ref),
+                'failing': failing, 'open': True,
+                'mergeable': 'CONFLICTING' if conflicting else 'MERGEABLE'}
+
+    def open_pulls(self, owner, repo):
+        if owner != self.owner or repo not in self.pulls:
+            return None
+        return [p for p in self.pulls[repo] if p['open']]
+
+    def contexts(self, pull):
+        return [{'context': 'continuous-integration/travis-ci',
+                 'state': 'failure' if pull['failing'] else 'success'},
+                PYUP]
+
+    def status(self, owner, repo, ref):
+        pulls = self.open_pulls(owner, repo)
+        for p in pulls or []:
+            if ref in (p['ref'], p['sha']):
+                contexts = self.contexts(p)
+                state = 'failure' if p['failing'] else 'success'
+                return (200, {'state': state, 'sha': p['sha'],
+                              'statuses': contexts}, {})
+        return (404, {'message': 'Not Found'}, {})
+
+    def pull_list(self, owner, repo, query, url):
+        pulls = self.open_pulls(owner, repo)
+        if pulls is None:
+            return (404, {'message': 'Not Found'}, {})
+        head = query.get('head', [None])[0]
+        if head:
+            pulls = [p for p in pulls
+                     if '%s:%s' % (self.owner, p['ref']) == head]
+        per_page = min(int(query.get('per_page', [self.per_page])[0]),
+                       self.per_page)
+        page = int(query.get('page', ['1'])[0])
+        last = max((len(pulls) + per_page - 1) // per_page, 1)
+        headers = {}
+        if page < last:
+            links = []
+            for (n, rel) in ((page + 1, 'next'), (last, 'last')):
+                params = dict((k, v[0]) for (k, v) in query.items())
+                params['page'] = n
+                links.append('<%s?%s>; rel="%s"' % (
+                    url, urlencode(params), rel))
+            headers['Link'] = ', '.join(links)
+        body = [{'number': p['number'], 'state': 'open',
+                 'head': {'ref': p['ref'], 'sha': p['sha']}}
+                for p in pulls[(page - 1) * per_page:page * per_page]]
+        return (200, body, headers)
+
+    def merge(self, owner, repo, number):
+        for p in self.open_pulls(owner, repo) or []:
+            if p['number'] != number:
+                continue
+            if p['mergeable'] == 'CONFLICTING':
+                return (405, {'message': 'Pull Request is not mergeable'},
+                        {})
+            p['open'] = False
+            return (200, {'merged': True, 'sha': sha(p['sha'], 'merge'),
+                          'message': 'Pull Request successfully merged'}, {})
+        return (404, {'message': 'Not Found'}, {})
+
+    def graphql(self, request):
+        variables = request.get('variables') or {}
+        owner = variables.get('owner')
+        branch = variables.get('branch')
+        data = {}
+        for (alias, repo) in variables.items():
+            if alias in ('owner', 'branch'):
+                continue
+            pulls = self.open_pulls(owner, repo)
+            if pulls is None:
+                data[alias] = None
+                continue
+            nodes = [{
+                'number': p['number'],
+                'mergeable': p['mergeable'],
+                'headRefOid': p['sha'],
+                'commits': {'nodes': [{'commit': {'status': {'contexts': [
+                    {'context': c['context'], 'state': c['state'].upper()}
+                    for c in self.contexts(p)]}}}]},
+            } for p in pulls if p['ref'] == branch][:1]
+            data[alias] = {'name': repo, 'pullRequests': {'nodes': nodes}}
+        return (200, {'data': data}, {})
+
+    def route(self, method, url, body):
+        # (status, json, headers) for a request, and the kind of call it
+        # was, for counting
+        parsed = urlparse(url)
+        (path, query) = (parsed.path, parse_qs(parsed.query))
+        match = STATUS.search(path)
+        if method == 'GET' and match:
+            return (self.status(*match.groups()), 'status')
+        match = PULLS.search(path)
+        if method == 'GET' and match:
+            (owner, repo) = match.groups()
+            return (self.pull_list(owner, repo, query, self.url() + path),
+                    'pulls')
+        match = MERGE.search(path)
+        if method == 'PUT' and match:
+            (owner, repo, number) = match.groups()
+            return (self.merge(owner, repo, int(number)), 'merge')
+        if method == 'POST' and path.endswith('/graphql'):
+            return (self.graphql(json.loads(body or b'{}')), 'graphql')
+        return ((404, {'message': 'Not Found'}, {}), 'other')
+
+    def rate_headers(self, now):
+        if self.rate_limit is None:
+            return {}
+        window = int(now // self.rate_window)
+        if window != self.window:
+            self.window = window
+            self.used = 0
+        reset = (window + 1) * self.rate_window
+        return {'X-RateLimit-Limit': str(self.rate_limit),
+                'X-RateLimit-Remaining': str(
+                    max(self.rate_limit - self.used, 0)),
+                'X-RateLimit-Reset': str(int(reset))}
+
+    def handle(self, method, url, headers, body):
+        # (status, headers, body bytes) for a request
+        time.sleep(self.latency)
+        with self.lock:
+            now = time.time()
+            rate = self.rate_headers(now)
+            if rate and self.used >= self.rate_limit:
+                self.calls['rate limited'] += 1
+                return (403, rate, json.dumps(
+                    {'message': 'API rate limit exceeded'}).encode())
+            if self.failures.random() < self.failure_rate:
+                self.calls['failed'] += 1
+                return (502, rate, b'{"message": "Server Error"}')
+            ((status, content, extra), kind) = self.route(method, url, body)
+            self.calls[kind] += 1
+            data = json.dumps(content).encode()
+            etag = '"%s"' % hashlib.sha1(data).hexdigest()
+            if method == 'GET' and headers.get('If-None-Match') == etag:
+                # conditional requests that come back 304 are free
+                return (304, dict(rate, ETag=etag), b'')
+            self.used += 1
+            self.billed += 1
+            rate = self.rate_headers(now)
+            return (status, dict(rate, ETag=etag, **extra), data)
+
+    def start(self, port=0):
+        self.server = Server(('127.0.0.1', port), Handler)
+        self.server.github = self
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        return self.url()
+
+    def url(self):
+        if self.server is None:
+            return ''
+        return 'http://%s:%d' % self.server.server_address
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self):
+        github = self.server.github
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        with github.lock:
+            github.connections.add(self.client_address)
+        (status, headers, data) = github.handle(
+            self.command, self.path, self.headers, body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = respond
+    do_POST = respond
+    do_PUT = respond
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='serve a fake Github API for runner.py --api_base')
+    parser.add_argument('--repos', default='repos.txt',
+                        help='path to repos.txt file')
+    parser.add_argument('--owner', default='ccnmtl')
+    parser.add_argument('--branch', required=True,
+                        help='the pull requests\' branch')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds to take over each request')
+    parser.add_argument('--per-page', type=int, default=30,
+                        help='most pull requests in a page')
+    parser.add_argument('--pulls', type=int, default=0,
+                        help='other open pull requests in each repo')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='fraction of requests that get a 502')
+    parser.add_argument('--rate-limit', type=int,
+                        help='requests allowed per --rate-window')
+    parser.add_argument('--rate-window', type=int, default=60,
+                        help='seconds')
+    parser.add_argument('--failing', type=float, default=0.0,
+                        help='fraction of pull requests with failing CI')
+    parser.add_argument('--conflicting', type=float, default=0.0,
+                        help='fraction of pull requests that won\'t merge')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    with open(args.repos) as f:
+        names = [line.strip() for line in f]
+    github = FakeGithub(
+        args.owner, names, args.branch, args.latency, args.per_page,
+        args.failure_rate, args.rate_limit, args.rate_window, args.pulls,
+        args.failing, args.conflicting, args.seed)
+    print('serving %d repos on %s' % (len(names), github.start(args.port)))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        github.stop()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# a synthetic, all local, set of repos to run upgrayedd.py and runner.py
+# against, for benchmarking: for each repo a bare "origin" and a clone of
+# it, with a requirements.txt and a Makefile that sleeps, burns cpu and
+# fails as asked, and a fake `hub` to take the pull requests.
+
+import argparse
+import os
+import random
+import shutil
+import sys
+
+from engine import run_sync, gather_bounded, call
+
+# (package, [(version, weight), ...], chance a repo pins it), roughly as
+# pins are spread over our django projects
+PINS = [
+    ('Django', [('2.2.12', 6), ('2.2.13', 3), ('3.0.6', 2), ('3.0.7', 1)],
+     1.0),
+    ('psycopg2-binary', [('2.8.4', 3), ('2.8.5', 5)], 0.9),
+    ('requests', [('2.22.0', 2), ('2.23.0', 6)], 0.8),
+    ('urllib3', [('1.25.8', 3), ('1.25.9', 4)], 0.8),
+    ('certifi', [('2019.11.28', 2), ('2020.4.5.1', 5)], 0.8),
+    ('idna', [('2.8', 2), ('2.9', 6)], 0.8),
+    ('chardet', [('3.0.4', 1)], 0.8),
+    ('pytz', [('2019.3', 2), ('2020.1', 5)], 0.9),
+    ('sqlparse', [('0.3.0', 2), ('0.3.1', 5)], 0.9),
+    ('six', [('1.14.0', 3), ('1.15.0', 4)], 0.7),
+    ('gunicorn', [('20.0.4', 1)], 0.6),
+    ('sentry-sdk', [('0.14.3', 2), ('0.14.4', 2), ('0.15.1', 3)], 0.6),
+    ('django-waffle', [('0.20.0', 3), ('1.0.0', 2)], 0.4),
+    ('django-bootstrap3', [('12.1.0', 2), ('14.0.0', 3)], 0.4),
+    ('django-extensions', [('2.2.8', 2), ('2.2.9', 3)], 0.5),
+    ('djangorestframework', [('3.11.0', 4)], 0.5),
+    ('Markdown', [('3.2.1', 2), ('3.2.2', 2)], 0.3),
+    ('Pillow', [('7.0.0', 2), ('7.1.2', 3)], 0.4),
+    ('coverage', [('5.0.4', 2), ('5.1', 4)], 0.9),
+    ('flake8', [('3.7.9', 3), ('3.8.1', 2)], 0.9),
+    ('pyflakes', [('2.1.1', 3), ('2.2.0', 2)], 0.9),
+    ('factory-boy', [('2.12.0', 4)], 0.6),
+    ('Faker', [('4.0.3', 2), ('4.1.0', 3)], 0.6),
+]
+
+MAKEFILE = """\
+all:
+\t@sleep {sleep}
+\t@{python} -c "sum(range({cpu}))"
+\t@echo built
+\t@exit {status}
+
+publish:
+\t@echo published
+"""
+
+HUB = """\
+#!/bin/sh
+# stands in for github's hub: takes a pull request and does nothing
+sleep {latency}
+echo fake hub "$@"
+"""
+
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'farm', 'GIT_AUTHOR_EMAIL': 'farm@localhost',
+    'GIT_COMMITTER_NAME': 'farm', 'GIT_COMMITTER_EMAIL': 'farm@localhost',
+}
+
+
+def requirements(rng):
+    lines = []
+    for (package, versions, chance) in PINS:
+        if rng.random() < chance:
+            (version,) = rng.choices(
+                [v for (v, w) in versions], [w for (v, w) in versions])
+            lines.append('%s==%s\n' % (package, version))
+    return ''.join(lines)
+
+
+class Farm(object):
+    # origin/<repo>.git, base/<repo>, repos.txt and hub under path
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.origin = os.path.join(self.path, 'origin')
+        self.base = os.path.join(self.path, 'base')
+        self.repos = os.path.join(self.path, 'repos.txt')
+        self.hub = os.path.join(self.path, 'hub')
+
+    def remote(self):
+        # for --remote
+        return os.path.join(self.origin, '{}.git')
+
+    def names(self):
+        with open(self.repos) as f:
+            return [line.strip() for line in f]
+
+    def write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    async def make_repo(self, repo, text, makefile):
+        origin = os.path.join(self.origin, repo + '.git')
+        clone = os.path.join(self.base, repo)
+        env = dict(os.environ, **GIT_ENV)
+        # whatever init.defaultBranch says, these are on master
+        for cmd in (['git', 'init', '-q', '--bare', origin],
+                    ['git', '--git-dir', origin,
+                     'symbolic-ref', 'HEAD', 'refs/heads/master'],
+                    ['git', 'init', '-q', clone]):
+            ret = await call(cmd, env=env)
+            if ret:
+                return ret
+        self.write(os.path.join(clone, 'requirements.txt'), text)
+        self.write(os.path.join(clone, 'Makefile'), makefile)
+        self.write(os.path.join(clone, '.gitignore'), 've/\n')
+        for cmd in (['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'],
+                    ['git', 'remote', 'add', 'origin', origin],
+                    ['git', 'add', '.'],
+                    ['git', 'commit', '-q', '-m', 'init'],
+                    ['git', 'push', '-q', '-u', 'origin', 'master']):
+            ret = await call(cmd, cwd=clone, env=env)
+            if ret:
+                return ret
+
+    def create(self, count, sleep=0.0, cpu=0, fail=0.0, hub_latency=0.0,
+               seed=0, jobs=8):
+        # starts over; the same arguments always make the same farm
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.origin)
+        os.makedirs(self.base)
+        rng = random.Random(seed)
+        names = ['repo%04d' % i for i in range(count)]
+        work = []
+        for r in names:
+            makefile = MAKEFILE.format(
+                sleep=sleep, cpu=cpu, python=sys.executable,
+                status=1 if rng.random() < fail else 0)
+            work.append(self.make_repo(r, requirements(rng), makefile))
+        results = run_sync(gather_bounded(work, jobs))
+        if any(results):
+            raise RuntimeError('could not create the farm repos')
+        self.write(self.repos, ''.join(r + '\n' for r in names))
+        self.write(self.hub, HUB.format(latency=hub_latency))
+        os.chmod(self.hub, 0o755)
+        return names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='make a farm of local repos to benchmark against')
+    parser.add_argument('path', help='directory to make it in')
+    parser.add_argument('--count', type=int, default=10,
+                        help='number of repos')
+    parser.add_argument('--sleep', type=float, default=0.0,
+                        help='seconds each `make` sleeps for')
+    parser.add_argument('--cpu', type=int, default=0,
+                        help='size of the sum each `make` works out')
+    parser.add_argument('--fail', type=float, default=0.0,
+                        help='fraction of repos whose `make` fails')
+    parser.add_argument('--hub-latency', type=float, default=0.0,
+                        help='seconds the fake hub takes per pull request')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jobs', type=int, default=8,
+                        help='number of repos to make at once')
+    args = parser.parse_args()
+    farm = Farm(args.path)
+    farm.create(args.count, args.sleep, args.cpu, args.fail,
+                args.hub_latency, args.seed, args.jobs)
+    print('%d repos in %s' % (args.count, farm.path))
@@ -0,0 +1,170 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ratelimit import RateLimiter, MAX_BACKOFF
+
+API_BASE = 'https://api.github.com'
+# server errors that are usually gone by the time a request is retried
+TRANSIENT = (500, 502, 503, 504)
+
+# pyup's safety check fails whenever anything is out of date, so its
+# status doesn't block a merge
+IGNORED_CONTEXTS = ['pyup.io/safety-ci']
+
+PULL_REQUEST_QUERY = '''
+  %(alias)s: repository(owner: $owner, name: $%(alias)s) {
+    name
+    pullRequests(headRefName: $branch, states: OPEN, first: 1) {
+      nodes {
+        number
+        mergeable
+        headRefOid
+        commits(last: 1) {
+          nodes { commit { status { contexts { context state } } } }
+        }
+      }
+    }
+  }
+'''
+
+
+def graphql_url(api_base):
+    # github enterprise serves REST under /api/v3, but GraphQL at
+    # /api/graphql rather than /api/v3/graphql
+    if api_base.endswith('/api/v3'):
+        return api_base[:-len('/v3')] + '/graphql'
+    return api_base + '/graphql'
+
+
+class GithubClient(object):
+    # one keep-alive session shared by every repo's API steps, with a
+    # worker pool sized to match the connection pool
+
+    def __init__(self, api_token, api_base=API_BASE, pool_size=10,
+                 cache=None, max_retries=5):
+        self.api_base = api_base.rstrip('/')
+        self.graphql_url = graphql_url(self.api_base)
+        self.cache = cache
+        self.limiter = RateLimiter(pool_size)
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'token %s' % api_token
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+
+    def url(self, path):
+        return self.api_base + path
+
+    def request(self, method, path, **kwargs):
+        return self.send(method, self.url(path), **kwargs)
+
+    def send(self, method, url, **kwargs):
+        # rate limited requests are queued and retried rather than
+        # handed back as failures, and so, after an exponential backoff,
+        # are transient server errors and failed connections, until
+        # max_retries runs out
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            response = None
+            error = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                self.limiter.release(response)
+            if self.limiter.limited(response):
+                continue
+            if error is None and response.status_code not in TRANSIENT:
+                break
+            if attempt == self.max_retries:
+                if error is not None:
+                    raise error
+                break
+            time.sleep(min(2 ** attempt, MAX_BACKOFF))
+        return response
+
+    def get(self, path, params=None, **kwargs):
+        if self.cache is None:
+            return self.request('GET', path, params=params, **kwargs)
+
+        url = requests.Request(
+            'GET', self.url(path), params=params).prepare().url
+        key = self.cache.key(self.session.headers['Authorization'], url)
+        entry = self.cache.load(key)
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry is not None:
+            headers.update(self.cache.validators(entry))
+
+        response = self.send('GET', url, headers=headers, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            return self.cache.response(entry)
+        if response.status_code == 200:
+            self.cache.store(key, response)
+        return response
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def graphql(self, query, variables):
+        response = self.send(
+            'POST', self.graphql_url,
+            json={'query': query, 'variables': variables})
+        if response.status_code != 200:
+            return {}
+        return response.json().get('data') or {}
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+
+def pull_request_info(node):
+    commits = node['commits']['nodes']
+    status = commits[0]['commit']['status'] if commits else None
+    contexts = status['contexts'] if status else []
+    return {
+        'number': node['number'],
+        'sha': node['headRefOid'],
+        'mergeable': node['mergeable'],
+        'failing': [c['context'] for c in contexts
+                    if c['context'] not in IGNORED_CONTEXTS and
+                    c['state'] == 'FAILURE'],
+    }
+
+
+def lookup_batch(client, owner, repos, branch):
+    aliases = ['r%d' % i for i in range(len(repos))]
+    query = 'query($owner: String!, $branch: String!, %s) {%s}' % (
+        ', '.join('$%s: String!' % a for a in aliases),
+        ''.join(PULL_REQUEST_QUERY % {'alias': a} for a in aliases))
+    variables = dict(zip(aliases, repos), owner=owner, branch=branch)
+    data = client.graphql(query, variables)
+
+    results = {}
+    for (alias, repo) in zip(aliases, repos):
+        if not data.get(alias):
+            # unknown repo or failed batch: leave it to the REST steps
+            continue
+        nodes = data[alias]['pullRequests']['nodes']
+        results[repo] = pull_request_info(nodes[0]) if nodes else None
+    return results
+
+
+def lookup_pull_requests(client, owner, repos, branch, batch_size=50):
+    # the open PR for branch in every repo, with its head sha,
+    # mergeability and failing statuses, in one query per batch_size
+    # repos. maps repo to that info, or to None if it has no such PR.
+    results = {}
+    for i in range(0, len(repos), batch_size):
+        results.update(
+            lookup_batch(client, owner, repos[i:i + batch_size], branch))
+    return results
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import tempfile
+
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+KEPT_HEADERS = ['Content-Type', 'ETag', 'Last-Modified', 'Link']
+
+
+class ETagCache(object):
+    # GET responses stored on disk, one file per URL, with their ETag and
+    # Last-Modified so they can be revalidated with a conditional request.
+    # github doesn't count a 304 against the rate limit. least recently
+    # used entries are evicted once the files add up to max_bytes.
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, *parts):
+        return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def load(self, key):
+        filename = self.filename(key)
+        try:
+            with open(filename) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        os.utime(filename, None)
+        return entry
+
+    def validators(self, entry):
+        headers = {}
+        if entry['headers'].get('ETag'):
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if entry['headers'].get('Last-Modified'):
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        return headers
+
+    def store(self, key, response):
+        entry = {
+            'url': response.url,
+            'headers': dict((h, response.headers[h]) for h in KEPT_HEADERS
+                            if h in response.headers),
+            'body': response.content.decode('utf-8', 'surrogateescape'),
+        }
+        if not self.validators(entry):
+            return
+        (fd, tmp) = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, self.filename(key))
+        self.evict()
+
+    def response(self, entry):
+        response = Response()
+        response.status_code = 200
+        response.url = entry['url']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = entry['body'].encode('utf-8', 'surrogateescape')
+        response.encoding = 'utf-8'
+        return response
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, name) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,128 @@
+import collections
+import json
+import os
+import threading
+import time
+
+# task attributes that steps set for the steps after them, carried over
+# when a task is resumed past the step that set them
+CARRIED = ('changes', 'number')
+# durations of each repo's step kept from earlier runs, the most recent
+HISTORY = 100
+
+
+def load(path):
+    # the journal's records; a crash mid-write leaves at most a torn last
+    # line, which is dropped
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+class Journal(object):
+    # an append-only JSONL log of each repo's completed steps and
+    # outcome, fsync'd as it goes so it survives the run dying part way
+    # through. with resume, tasks pick up after the last step they
+    # completed in earlier runs.
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.resume = resume
+        self.repos = {}
+        self.walls = {}
+        for record in load(path):
+            self.replay(record)
+        self.lock = threading.Lock()
+        self.f = open(path, 'a')
+        if self.f.tell() and not self.ends_with_newline():
+            # start after a torn line rather than on the end of it
+            self.f.write('\n')
+
+    def ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def entry(self, repo):
+        return self.repos.setdefault(
+            repo, {'labels': [], 'status': 'running', 'state': {}})
+
+    def replay(self, record):
+        repo = record['repo']
+        if record['event'] == 'start':
+            if not record['resumed']:
+                self.repos.pop(repo, None)
+            self.entry(repo)['status'] = 'running'
+        elif record['event'] == 'step':
+            entry = self.entry(repo)
+            del entry['labels'][record['index']:]
+            entry['labels'].append(record['label'])
+            entry['state'] = record['state']
+            if record.get('wall') is not None:
+                self.walls.setdefault(
+                    (repo, record['label']),
+                    collections.deque(maxlen=HISTORY)).append(record['wall'])
+        elif record['event'] == 'finish':
+            self.entry(repo)['status'] = record['status']
+
+    def write(self, record):
+        record['time'] = time.time()
+        with self.lock:
+            self.f.write(json.dumps(record) + '\n')
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def failed(self, repos):
+        # those of repos that didn't succeed or get skipped the last time
+        # they ran: that failed, were cut off or cancelled, or never ran
+        done = ('success', 'skipped')
+        return [r for r in repos
+                if r not in self.repos or self.repos[r]['status'] not in done]
+
+    def durations(self, repo, label):
+        # how long the step took each time it completed, in earlier runs
+        return list(self.walls.get((repo, label), ()))
+
+    def resume_point(self, task, steps):
+        # (steps already done, outcome) for a task being resumed; the
+        # steps have to line up with the ones the journal saw
+        entry = self.repos.get(task.repo)
+        if not self.resume or entry is None:
+            return (0, None)
+        labels = [s.label for s in steps]
+        if entry['status'] in ('success', 'skipped'):
+            if entry['labels'] == labels[:len(entry['labels'])]:
+                return (len(steps), entry['status'])
+            return (0, None)
+        if not task.resumable():
+            return (0, None)
+        done = len(entry['labels'])
+        if entry['labels'] != labels[:done]:
+            return (0, None)
+        for (name, value) in entry['state'].items():
+            setattr(task, name, value)
+        return (done, None)
+
+    def started(self, task, done):
+        self.write({'event': 'start', 'repo': task.repo, 'resumed': done})
+
+    def step_done(self, task, index, step):
+        state = dict((name, getattr(task, name)) for name in CARRIED
+                     if hasattr(task, name))
+        wall = step.timing.wall if step.timing is not None else None
+        self.write({'event': 'step', 'repo': task.repo, 'index': index,
+                    'label': step.label, 'state': state, 'wall': wall})
+
+    def finished(self, task):
+        self.write({'event': 'finish', 'repo': task.repo,
+                    'status': task.status, 'log': task.log})
+
+    def close(self):
+        self.f.close()
@@ -0,0 +1,129 @@
+import collections
+import os
+import sys
+import threading
+
+# lines longer than this are broken up, so a command that never prints a
+# newline can't grow a line without bound
+MAX_LINE = 4096
+
+
+def print_tail(lines):
+    # under a failure in print_report
+    for line in lines or ():
+        print('\t\t| %s' % line)
+
+
+def read_tail(path, start, end, count):
+    # the last count lines between offsets start and end of a file,
+    # reading no more of it than they could take up
+    size = min(end - start, count * (MAX_LINE + 1))
+    with open(path, 'rb') as f:
+        f.seek(end - size)
+        data = f.read(size)
+    lines = data.split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+    return [line[:MAX_LINE] for line in lines[-count:]]
+
+
+class StepOutput(object):
+    # what one step's commands print (see engine.sink): appended to the
+    # repo's log file, the last lines of it kept for the report, and with
+    # live, echoed to our stdout a line at a time behind a [repo] prefix.
+    #
+    # when nothing needs to see the output on its way to the log file, it
+    # is spliced there by the kernel (or where that can't be done, just
+    # written there) and only if the step fails are its last lines read
+    # back.
+
+    def __init__(self, capture, repo, f=None):
+        self.capture = capture
+        self.prefix = ('[%s] ' % repo).encode()
+        self.f = f
+        self.start = self.end = f.tell() if f is not None else 0
+        self.only_file = f is not None and not capture.live
+        self.lines = collections.deque(maxlen=capture.tail)
+        self.partial = b''
+
+    def splice_target(self):
+        return self.f.fileno() if self.only_file else None
+
+    def feed(self, data):
+        if self.f is not None:
+            self.f.write(data)
+        if self.only_file:
+            return
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        if len(self.partial) > MAX_LINE:
+            lines.append(self.partial)
+            self.partial = b''
+        self.add(lines)
+
+    def add(self, lines):
+        if not lines:
+            return
+        if self.capture.live:
+            self.capture.echo(
+                b''.join(self.prefix + line + b'\n' for line in lines))
+        self.lines.extend(
+            line[:MAX_LINE] for line in lines[-self.capture.tail:])
+
+    def close(self):
+        if self.partial:
+            self.add([self.partial])
+            self.partial = b''
+        if self.f is not None:
+            self.end = self.f.tell()
+            self.f.close()
+
+    def tail(self):
+        lines = self.lines
+        if self.only_file and self.end > self.start:
+            lines = read_tail(
+                self.f.name, self.start, self.end, self.capture.tail)
+        return [line.decode('utf-8', 'replace') for line in lines]
+
+
+class LogCapture(object):
+    # captures the output of every command a step runs, instead of
+    # letting it through to the terminal: to <path>/<repo>.log, started
+    # afresh each run, when there's a path, and as a live stream with
+    # each line prefixed by its repo when live is set. either way the
+    # last `tail` lines of a step are kept, to show if it fails.
+
+    def __init__(self, path=None, live=False, tail=20):
+        self.path = path
+        self.live = live
+        self.tail = max(tail, 1)
+        self.opened = set()
+        self.lock = threading.Lock()
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def log_path(self, repo):
+        return os.path.join(self.path, repo + '.log')
+
+    def start(self, task, step):
+        f = None
+        if self.path:
+            with self.lock:
+                mode = 'r+b' if task.repo in self.opened else 'wb'
+                self.opened.add(task.repo)
+            # unbuffered, and not in append mode, which splice won't write
+            # to
+            f = open(self.log_path(task.repo), mode, buffering=0)
+            f.seek(0, os.SEEK_END)
+            cmd = step.command()
+            header = '==> %s' % step.label
+            if cmd:
+                header += ': ' + ' '.join(cmd)
+            f.write((header + '\n').encode())
+        return StepOutput(self, task.repo, f)
+
+    def echo(self, data):
+        with self.lock:
+            sys.stdout.flush()
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
@@ -0,0 +1,41 @@
+import os
+
+from engine import run_sync, gather_bounded, call
+
+REMOTE = 'git@github.com:ccnmtl/{}.git'
+# what `git fetch origin` would give us, taken from the mirror instead
+ORIGIN_REFSPEC = '+refs/heads/*:refs/remotes/origin/*'
+
+
+class MirrorCache(object):
+    # a bare `git clone --mirror` of each repo, brought up to date once
+    # per run, that clones borrow objects from (--reference) and that
+    # checkouts fetch from instead of going to github
+
+    def __init__(self, path, remote=REMOTE):
+        self.path = os.path.abspath(path)
+        self.remote = remote
+
+    def mirror_path(self, repo):
+        return os.path.join(self.path, repo + '.git')
+
+    def has(self, repo):
+        # whether there's a mirror of repo; there isn't when update_all
+        # couldn't make one
+        return os.path.isdir(self.mirror_path(repo))
+
+    async def update(self, repo):
+        mirror = self.mirror_path(repo)
+        if os.path.exists(mirror):
+            return await call(['git', 'remote', 'update', '--prune'],
+                              cwd=mirror)
+        return await call(['git', 'clone', '--mirror',
+                           self.remote.format(repo), mirror])
+
+    def update_all(self, names, jobs=1):
+        # returns the repos that couldn't be mirrored
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        results = run_sync(gather_bounded(
+            [self.update(r) for r in names], jobs))
+        return [r for (r, ret) in zip(names, results) if ret]
@@ -0,0 +1,114 @@
+import threading
+import time
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+
+MAX_BACKOFF = 60
+
+
+def retry_after(value, now):
+    # a Retry-After header's time, from either its delay-seconds or its
+    # HTTP-date form; None if it's neither
+    try:
+        return now + int(value)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if when.tzinfo is None:
+        # HTTP dates are always GMT
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
+
+
+class RateLimiter(object):
+    # throttles every request a GithubClient makes, from any thread.
+    #
+    # X-RateLimit-Remaining/Reset on each response hold requests back once
+    # the budget is nearly spent, and a rate limited response (429, or a
+    # 403 for the primary or secondary limit) pauses everything until its
+    # Retry-After, the reset time, or an exponential backoff has passed.
+    # concurrency is halved on every limited response and grows back by
+    # one after each run of successful ones, so it settles just under the
+    # point where github starts pushing back.
+
+    def __init__(self, max_concurrency=10, reserve=None):
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        if reserve is None:
+            reserve = max_concurrency
+        self.reserve = reserve
+        self.active = 0
+        self.successes = 0
+        self.strikes = 0
+        self.remaining = None
+        self.reset_at = 0
+        self.blocked_until = 0
+        self.cond = threading.Condition()
+
+    def wait_time(self, now):
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        if (self.remaining is not None and self.remaining <= self.reserve and
+                self.reset_at > now):
+            return self.reset_at - now
+        return 0
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                wait = self.wait_time(time.time())
+                if wait > 0:
+                    self.cond.wait(wait)
+                elif self.active < self.concurrency:
+                    self.active += 1
+                    return
+                else:
+                    self.cond.wait()
+
+    def release(self, response):
+        with self.cond:
+            self.active -= 1
+            if response is not None:
+                self.update(response)
+            self.cond.notify_all()
+
+    def limited(self, response):
+        if response is None:
+            return False
+        if response.status_code == 429:
+            return True
+        if response.status_code != 403:
+            return False
+        return (response.headers.get('X-RateLimit-Remaining') == '0' or
+                'Retry-After' in response.headers or
+                b'rate limit' in response.content.lower())
+
+    def update(self, response):
+        now = time.time()
+        headers = response.headers
+        if 'X-RateLimit-Remaining' in headers:
+            self.remaining = int(headers['X-RateLimit-Remaining'])
+            self.reset_at = int(headers.get('X-RateLimit-Reset', 0))
+
+        if not self.limited(response):
+            self.strikes = 0
+            self.successes += 1
+            if self.successes >= self.concurrency:
+                self.successes = 0
+                self.concurrency = min(
+                    self.concurrency + 1, self.max_concurrency)
+            return
+
+        self.successes = 0
+        self.strikes += 1
+        self.concurrency = max(1, self.concurrency // 2)
+        until = retry_after(headers.get('Retry-After', ''), now)
+        if until is None:
+            if self.remaining == 0 and self.reset_at > now:
+                until = self.reset_at
+            else:
+                until = now + min(2 ** self.strikes, MAX_BACKOFF)
+        self.blocked_until = max(self.blocked_until, until)
@@ -0,0 +1,65 @@
+import json
+import threading
+import time
+
+from timing import summarize
+
+
+def step_status(step):
+    # what the step's result meant for the task
+    if not step.timing.returncode:
+        return 'ok'
+    if step.skip_fail == 'fail':
+        return 'failed'
+    return 'skipped'
+
+
+class Report(object):
+    # the machine readable counterpart of print_report: a JSON line for
+    # each step and each repo as it finishes, then one summing up the run
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'w')
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def write(self, record):
+        record['time'] = time.time()
+        with self.lock:
+            self.f.write(json.dumps(record) + '\n')
+            self.f.flush()
+
+    def step(self, task, step):
+        record = {'event': 'step', 'repo': task.repo,
+                  'status': step_status(step)}
+        record.update(step.timing.as_dict())
+        if step.tail:
+            record['tail'] = list(step.tail)
+        self.write(record)
+
+    def repo(self, task, started):
+        self.write({'event': 'repo', 'repo': task.repo,
+                    'status': task.status, 'log': task.log,
+                    'tail': list(task.tail),
+                    'started': started, 'wall': time.time() - started})
+
+    def summary(self, failed, skipped, succeeded, timings, cancelled=()):
+        finished = time.time()
+        self.write({
+            'event': 'summary',
+            'started': self.started,
+            'finished': finished,
+            'wall': finished - self.started,
+            'failed': [{'repo': r, 'log': msg} for (r, msg) in failed],
+            'skipped': list(skipped),
+            'succeeded': list(succeeded),
+            'cancelled': [{'repo': r, 'log': msg} for (r, msg) in cancelled],
+            'counts': {'failed': len(failed), 'skipped': len(skipped),
+                       'succeeded': len(succeeded),
+                       'cancelled': len(cancelled)},
+            'steps': summarize(timings),
+        })
+
+    def close(self):
+        self.f.close()
@@ -0,0 +1,189 @@
+import json
+import os
+import re
+import subprocess
+import tempfile
+
+REQUIREMENTS_FILE = re.compile(r'^(requirements/)?requirements[^/]*\.txt$')
+PIN = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)(\[[^\]]*\])?\s*'
+                 r'==\s*([^\s;#]+)')
+SELECTOR = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(.*)$')
+CONSTRAINT = re.compile(r'^(==|!=|<=|>=|<|>)\s*(\S+)$')
+VERSION = re.compile(
+    r'^v?(\d+(?:\.\d+)*)'
+    r'(?:[-_.]?(a|b|c|rc|alpha|beta|pre|preview)[-_.]?(\d*))?'
+    r'(?:-(\d+)|[-_.]?(post|rev|r)[-_.]?(\d*))?'
+    r'(?:[-_.]?(dev)[-_.]?(\d*))?'
+    r'(?:\+([a-z0-9._-]*))?$', re.IGNORECASE)
+# pre-release phases, in order
+PRE = {'a': 0, 'alpha': 0, 'b': 1, 'beta': 1,
+       'c': 2, 'rc': 2, 'pre': 2, 'preview': 2}
+OPERATORS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+def normalize(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def version_key(version):
+    # PEP 440 ordering, without having to depend on packaging: 2.2 ==
+    # 2.2.0, 2.0.dev1 < 2.0a1 < 2.0rc1 < 2.0 < 2.0+local < 2.0.post1.
+    # anything that isn't a PEP 440 version sorts before the ones that
+    # are, by its text.
+    m = VERSION.match(version.strip())
+    if m is None:
+        return ((), (-1, 0), -1, (1, 0), version)
+    release = [int(n) for n in m.group(1).split('.')]
+    while release and release[-1] == 0:
+        release.pop()
+    (pre, pre_n, post_n, post, post_n2, dev, dev_n, local) = m.groups()[1:]
+    if pre:
+        pre = (PRE[pre.lower()], int(pre_n or 0))
+    elif dev and not (post_n or post):
+        # 2.0.dev1 comes before 2.0's pre-releases, too
+        pre = (-1, 0)
+    else:
+        # after all of its pre-releases
+        pre = (3, 0)
+    if post_n:
+        post = int(post_n)
+    elif post:
+        post = int(post_n2 or 0)
+    else:
+        post = -1
+    dev = (0, int(dev_n or 0)) if dev else (1, 0)
+    return (tuple(release), pre, post, dev, (local or '').lower())
+
+
+def parse_pins(text):
+    pins = {}
+    for line in text.splitlines():
+        m = PIN.match(line)
+        if m:
+            pins[normalize(m.group(1))] = m.group(3)
+    return pins
+
+
+def parse_selector(selector):
+    # eg. 'django<2.2.13' or 'django>=2.2,<2.2.13'; a bare name
+    # selects every repo that pins the package at all
+    m = SELECTOR.match(selector)
+    if m is None:
+        raise ValueError('bad selector: %s' % selector)
+    constraints = []
+    for c in m.group(2).split(','):
+        if not c.strip():
+            continue
+        cm = CONSTRAINT.match(c.strip())
+        if cm is None:
+            raise ValueError('bad selector: %s' % selector)
+        constraints.append((OPERATORS[cm.group(1)],
+                            version_key(cm.group(2))))
+    return (normalize(m.group(1)), constraints)
+
+
+def git(repo_path, *args, **kwargs):
+    return subprocess.run(
+        ['git'] + list(args), cwd=repo_path, stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL, **kwargs)
+
+
+def requirements_blobs(repo_path, ref):
+    result = git(repo_path, 'ls-tree', '-r', ref)
+    if result.returncode:
+        return None
+    blobs = {}
+    for line in result.stdout.decode('utf-8').splitlines():
+        (info, path) = line.split('\t', 1)
+        if REQUIREMENTS_FILE.match(path):
+            blobs[path] = info.split()[2]
+    return blobs
+
+
+def read_blobs(repo_path, shas):
+    result = git(repo_path, 'cat-file', '--batch',
+                 input=''.join(s + '\n' for s in shas).encode('utf-8'))
+    contents = []
+    out = result.stdout
+    for _ in shas:
+        (header, out) = out.split(b'\n', 1)
+        size = int(header.split()[2])
+        contents.append(out[:size].decode('utf-8', 'replace'))
+        out = out[size + 1:]
+    return contents
+
+
+class RequirementsIndex(object):
+    # package -> pinned version -> repos, built from the requirements
+    # files at `ref` in each checkout, without checking anything out.
+    # repos are keyed by the blob shas of their requirements files, so a
+    # refresh only re-reads the repos whose requirements changed.
+
+    def __init__(self, path, ref='origin/master'):
+        self.path = path
+        self.ref = ref
+        self.repos = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('ref') == ref:
+                self.repos = data['repos']
+
+    def refresh(self, base, names):
+        for r in names:
+            repo_path = os.path.join(base, r)
+            blobs = requirements_blobs(repo_path, self.ref)
+            if blobs is None:
+                self.repos.pop(r, None)
+                continue
+            if self.repos.get(r, {}).get('blobs') == blobs:
+                continue
+            paths = sorted(blobs)
+            pins = {}
+            for text in read_blobs(repo_path, [blobs[p] for p in paths]):
+                pins.update(parse_pins(text))
+            self.repos[r] = {'blobs': blobs, 'pins': pins}
+
+    def packages(self):
+        packages = {}
+        for (r, entry) in sorted(self.repos.items()):
+            for (name, version) in entry['pins'].items():
+                packages.setdefault(name, {}).setdefault(
+                    version, []).append(r)
+        return packages
+
+    def select(self, selector, names=None):
+        (name, constraints) = parse_selector(selector)
+        selected = []
+        for (version, repos) in self.packages().get(name, {}).items():
+            key = version_key(version)
+            if all(op(key, v) for (op, v) in constraints):
+                selected.extend(repos)
+        if names is not None:
+            return [r for r in names if r in selected]
+        return sorted(selected)
+
+    def save(self):
+        if not self.path:
+            return
+        data = {'ref': self.ref, 'repos': self.repos,
+                'packages': self.packages()}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        (fd, tmp) = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def select_repos(base, names, selector, path=None, ref='origin/master'):
+    index = RequirementsIndex(path, ref)
+    index.refresh(base, names)
+    index.save()
+    return index.select(selector, names)
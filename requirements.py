@@ -0,0 +1,107 @@
+import os
+import re
+import tempfile
+from functools import lru_cache
+
+# perl's $1 / ${1} group references, as used in --replace
+PERL_GROUP = re.compile(r'\$\{?(\d+)\}?')
+
+
+class Replacement(object):
+    # an in-process `perl -pi -e s/match/replace/`: the first match on
+    # each line is replaced. matching is per line, like grep.
+
+    def __init__(self, match, replace):
+        self.match = match
+        self.replace = replace
+        self.pattern = re.compile(match, re.MULTILINE)
+        self.template = PERL_GROUP.sub(r'\\g<\1>', replace)
+
+    def apply_line(self, line):
+        return self.pattern.sub(self.template, line, count=1)
+
+    def apply(self, text):
+        return ''.join(self.apply_line(line)
+                       for line in text.splitlines(True))
+
+    def preview(self, text):
+        changes = []
+        for line in text.splitlines():
+            new = self.apply_line(line)
+            if new != line:
+                changes.append((line, new))
+        return changes
+
+
+class ReplacementSet(Replacement):
+    # several replacements applied together, in order, eg. from a
+    # manifest. it matches if any of them does.
+
+    def __init__(self, replacements):
+        self.replacements = replacements
+
+    def apply_line(self, line):
+        for r in self.replacements:
+            line = r.apply_line(line)
+        return line
+
+
+@lru_cache(maxsize=None)
+def compile_replacement(match, replace):
+    return Replacement(match, replace)
+
+
+def read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def write_atomic(path, text):
+    # write alongside the original and rename over it, so an interrupted
+    # run never leaves a half written requirements file behind
+    directory = os.path.dirname(os.path.abspath(path))
+    (fd, tmp) = tempfile.mkstemp(dir=directory, prefix='.requirements')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def rewrite(path, replacement):
+    # returns the (old, new) lines that changed, if any
+    text = read(path)
+    if text is None:
+        return []
+    new = replacement.apply(text)
+    if new == text:
+        return []
+    write_atomic(path, new)
+    return replacement.preview(text)
+
+
+def load_manifest(path):
+    # one `match replace` pair per line; blank lines and #comments are
+    # ignored. a line that isn't one raises ValueError naming it.
+    pairs = []
+    with open(path) as f:
+        for (lineno, line) in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split(None, 1)
+            if len(parts) != 2:
+                raise ValueError(
+                    '%s:%d: expected "match replace"' % (path, lineno))
+            try:
+                compile_replacement(parts[0], parts[1])
+            except re.error as e:
+                raise ValueError('%s:%d: %s' % (path, lineno, e))
+            pairs.append((parts[0], parts[1]))
+    return pairs
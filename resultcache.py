@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from engine import output
+from vestore import interpreter_id
+
+
+async def working_tree(repo_path, env=None):
+    # the tree sha of the working copy as it stands, uncommitted changes
+    # and untracked (but not ignored) files included, written through a
+    # scratch copy of the index so the real one isn't touched
+    (ret, index) = await output(
+        ['git', 'rev-parse', '--git-path', 'index'], cwd=repo_path)
+    if ret:
+        return None
+    index = os.path.join(repo_path, index.decode().strip())
+    (fd, scratch) = tempfile.mkstemp(suffix='.index')
+    os.close(fd)
+    try:
+        if os.path.exists(index):
+            shutil.copyfile(index, scratch)
+        else:
+            os.remove(scratch)
+        git_env = dict(env or os.environ, GIT_INDEX_FILE=scratch)
+        (ret, _) = await output(['git', 'add', '-A'],
+                                cwd=repo_path, env=git_env)
+        if ret:
+            return None
+        (ret, tree) = await output(['git', 'write-tree'],
+                                   cwd=repo_path, env=git_env)
+    finally:
+        if os.path.exists(scratch):
+            os.remove(scratch)
+    return tree.decode().strip() if not ret else None
+
+
+class ResultCache(object):
+    # outcomes of `make` keyed by (working tree sha, requirements.txt,
+    # interpreter, target). a recorded success means the same build can
+    # be skipped; failures are recorded but always re-run, since they're
+    # as often flaky downloads or tests as real breakage. with force, no
+    # earlier results are used, but new ones are still recorded.
+
+    def __init__(self, path, force=False, python='python'):
+        self.path = path
+        self.force = force
+        self.python = python
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    async def key(self, repo_path, requirements_path, cmd, env=None):
+        tree = await working_tree(repo_path, env)
+        if tree is None:
+            return None
+        digest = hashlib.sha256(tree.encode())
+        try:
+            with open(requirements_path, 'rb') as f:
+                digest.update(b'\0' + f.read())
+        except IOError:
+            pass
+        digest.update(b'\0' + interpreter_id(self.python))
+        digest.update(b'\0' + '\0'.join(cmd).encode())
+        return digest.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def hit(self, key):
+        if key is None or self.force:
+            return False
+        try:
+            with open(self.filename(key)) as f:
+                return json.load(f)['returncode'] == 0
+        except (IOError, ValueError):
+            return False
+
+    def record(self, key, returncode):
+        if key is None:
+            return
+        (fd, tmp) = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'returncode': returncode, 'time': time.time()}, f)
+        os.replace(tmp, self.filename(key))
@@ -1,92 +1,181 @@
 import argparse
+import sys
 
+from chrometrace import ChromeTrace
+from github import GithubClient, lookup_pull_requests, API_BASE
+from httpcache import ETagCache
+from journal import Journal
+from logs import LogCapture
+from mirrors import MirrorCache, REMOTE
+from report import Report
+from reqindex import select_repos
+from resultcache import ResultCache
+from steps import NETWORK, CPU, PUBLISH
+from timeouts import Timeouts
 from tasks import (
     TaskRunner, CloneTask, CheckoutTask, NewBranchTask, MakeTask,
     CommitAndPushTask, StatusTask, PublishTask, RequirementsUpdateTask,
     MergeMatchingPullRequestTask)
+from vestore import VirtualenvStore
+from wheelhouse import start_wheelhouse
 
 
 def main(args):
     base = args.base
     repos = args.repos
+    jobs = args.jobs
+    lanes = {
+        NETWORK: args.network_jobs,
+        CPU: args.cpu_jobs,
+        PUBLISH: args.publish_jobs,
+    }
 
     f = open(repos)
+    names = [line.strip() for line in f]
+    if args.where:
+        names = select_repos(
+            base, names, args.where, args.index, args.index_ref)
 
+    journal = None
+    if args.journal:
+        journal = Journal(args.journal, args.resume)
+        if args.rerun_failed:
+            names = journal.failed(names)
+
+    ve_store = None
+    if args.ve_store:
+        ve_store = VirtualenvStore(args.ve_store)
+
+    wheelhouse = None
+    env = None
+    if args.wheelhouse:
+        extra = [args.replace] if args.replace else []
+        (wheelhouse, env) = start_wheelhouse(
+            args.wheelhouse, base, names, args.index, args.index_ref, extra,
+            args.offline)
+
+    result_cache = None
+    if args.result_cache:
+        result_cache = ResultCache(args.result_cache, args.force)
+
+    mirrors = None
+    if args.mirrors:
+        mirrors = MirrorCache(args.mirrors, args.remote)
+        for r in mirrors.update_all(names, jobs):
+            print('could not mirror {}'.format(r))
+
+    report = None
+    if args.report:
+        report = Report(args.report)
+
+    trace = None
+    if args.trace:
+        trace = ChromeTrace(args.trace)
+
+    logs = None
+    if args.logs or args.live:
+        logs = LogCapture(args.logs, args.live, args.tail)
+
+    timeouts = None
+    if args.step_timeout or args.run_timeout or args.auto_timeouts:
+        timeouts = Timeouts(args.step_timeout, args.run_timeout, journal,
+                            args.auto_timeouts)
+
+    settings = {
+        'env': env,
+        've_store': ve_store,
+        'result_cache': result_cache,
+        'remote': args.remote,
+        'mirrors': mirrors,
+        'clone_filter': args.filter,
+        'clone_depth': args.depth,
+        'journal': journal,
+        'report': report,
+        'trace': trace,
+        'logs': logs,
+        'timeouts': timeouts,
+    }
+
+    # one mode a run, the first of these given
+    runner = None
     if args.clone:
         print('Clone')
-        runner = TaskRunner()
-        for line in f:
-            r = line.strip()
-            runner.run(CloneTask(base, r))
+        runner = TaskRunner(**settings)
+        runner.run_all([CloneTask(base, r) for r in names], jobs, lanes)
         runner.print_report()
-
-    if args.status:
+    elif args.status:
         print('Status')
-        runner = TaskRunner()
-        for line in f:
-            r = line.strip()
-            runner.run(StatusTask(base, r))
+        runner = TaskRunner(**settings)
+        runner.run_all([StatusTask(base, r) for r in names], jobs, lanes)
         runner.print_report()
-
-    if args.checkout:
+    elif args.checkout:
         print('Checkout a branch')
-        runner = TaskRunner()
-        for line in f:
-            r = line.strip()
-            runner.run(CheckoutTask(base, r, args.checkout))
+        runner = TaskRunner(**settings)
+        runner.run_all(
+            [CheckoutTask(base, r, args.checkout) for r in names], jobs, lanes)
         runner.print_report()
-
-    if args.new_branch:
+    elif args.new_branch:
         print('Create New Branch')
-        runner = TaskRunner()
-        for line in f:
-            r = line.strip()
-            runner.run(NewBranchTask(base, r, args.new_branch))
+        runner = TaskRunner(**settings)
+        runner.run_all(
+            [NewBranchTask(base, r, args.new_branch) for r in names],
+            jobs, lanes)
         runner.print_report()
-
-    if args.make:
+    elif args.make:
         print('Make All')
-        runner = TaskRunner()
-        for line in f:
-            r = line.strip()
-            runner.run(MakeTask(base, r))
+        runner = TaskRunner(**settings)
+        runner.run_all([MakeTask(base, r) for r in names], jobs, lanes)
         runner.print_report()
-
-    if args.commit:
+    elif args.commit:
         print('Commit And Push')
-        runner = TaskRunner()
-        for line in f:
-            r = line.strip()
-            runner.run(CommitAndPushTask(base, r, args.commit, args.message))
+        runner = TaskRunner(**settings)
+        runner.run_all(
+            [CommitAndPushTask(base, r, args.commit, args.message)
+             for r in names], jobs, lanes)
         runner.print_report()
-
-    if args.publish:
+    elif args.publish:
         print('Publish')
-        runner = TaskRunner()
-        for line in f:
-            r = line.strip()
-            runner.run(PublishTask(base, r))
+        runner = TaskRunner(**settings)
+        runner.run_all([PublishTask(base, r) for r in names], jobs, lanes)
         runner.print_report()
-
-    if args.match and args.replace:
+    elif args.match and args.replace:
         print('Requirements Update')
-        runner = TaskRunner()
-        for line in f:
-            r = line.strip()
-            runner.run(
-                RequirementsUpdateTask(base, r, args.match, args.replace))
+        runner = TaskRunner(**settings)
+        runner.run_all(
+            [RequirementsUpdateTask(base, r, args.match, args.replace)
+             for r in names], jobs, lanes)
         runner.print_report()
-
-    if args.match and args.owner:
+    elif args.match and args.owner:
         print('Merge pull request')
-        runner = TaskRunner()
-        for line in f:
-            r = line.strip()
-            runner.run(
-                MergeMatchingPullRequestTask(
-                    base, r, args.owner, args.match, args.api_token))
+        runner = TaskRunner(**settings)
+        cache = None
+        if args.cache:
+            cache = ETagCache(args.cache, args.cache_size * 1024 * 1024)
+        client = GithubClient(args.api_token, args.api_base,
+                              pool_size=jobs, cache=cache)
+        lookups = None
+        if args.batch:
+            lookups = lookup_pull_requests(
+                client, args.owner, names, args.match, args.batch)
+        runner.run_all(
+            [MergeMatchingPullRequestTask(
+                base, r, args.owner, args.match, args.api_token, client,
+                lookups)
+             for r in names], jobs, lanes)
+        client.close()
         runner.print_report()
 
+    if wheelhouse is not None:
+        wheelhouse.close()
+    if journal is not None:
+        journal.close()
+    if report is not None:
+        report.close()
+    if trace is not None:
+        trace.close()
+    if runner is not None and runner.interrupted:
+        return 130
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='upgrade libraries')
@@ -130,5 +219,121 @@ if __name__ == "__main__":
     parser.add_argument(
         '--api_token', help='Github oauth token')
 
+    parser.add_argument(
+        '--api_base', default=API_BASE,
+        help='Github API to talk to, eg. https://github.example.com/api/v3 '
+        'for Github Enterprise')
+    parser.add_argument(
+        '--batch', type=int, nargs='?', const=50,
+        help='look up pull requests and statuses with one GraphQL '
+        'query per this many repos (default 50)')
+    parser.add_argument(
+        '--cache', help='directory to cache Github API responses in')
+    parser.add_argument(
+        '--cache_size', type=int, default=50,
+        help='size limit for the API response cache, in MB')
+
+    parser.add_argument(
+        '--jobs', type=int, default=1,
+        help='number of repositories to work on at once')
+    parser.add_argument(
+        '--network_jobs', type=int,
+        help='limit on concurrent fetches and API lookups')
+    parser.add_argument(
+        '--cpu_jobs', type=int, help='limit on concurrent builds')
+    parser.add_argument(
+        '--publish_jobs', type=int,
+        help='limit on concurrent pushes, pull requests and merges')
+
+    parser.add_argument(
+        '--where',
+        help="only repos whose pins match, eg. 'django<2.2.13'")
+    parser.add_argument(
+        '--index', help='file to keep the requirements index in')
+    parser.add_argument(
+        '--index_ref', default='origin/master',
+        help='git ref to index requirements at')
+
+    parser.add_argument(
+        '--wheelhouse',
+        help='directory for a shared cache of every pinned package, '
+        'served to the builds as their package index')
+    parser.add_argument(
+        '--offline', action='store_true',
+        help='with --wheelhouse, do not fall back to PyPI')
+
+    parser.add_argument(
+        '--ve_store',
+        help='directory to build each distinct virtualenv once in, to be '
+        'linked into the repos')
+
+    parser.add_argument(
+        '--result_cache',
+        help='directory to remember successful builds in, so an '
+        'unchanged tree is not built again')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='build even if --result_cache has a success')
+
+    parser.add_argument(
+        '--remote', default=REMOTE,
+        help='git url for a repo, with {} for its name')
+    parser.add_argument(
+        '--mirrors',
+        help='directory of bare mirrors to clone and fetch from, updated '
+        'once at the start of the run')
+    parser.add_argument(
+        '--filter', help='partial clone filter, eg. blob:none')
+    parser.add_argument(
+        '--depth', type=int, help='shallow clone depth')
+
+    parser.add_argument(
+        '--journal',
+        help='file to log each repo\'s completed steps to as they happen')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='carry on from the steps --journal says were done')
+    parser.add_argument(
+        '--rerun_failed', action='store_true',
+        help='only the repos --journal has no success or skip for')
+
+    parser.add_argument(
+        '--report',
+        help='file to write a JSON line to for each step and repo as it '
+        'finishes, and a summary after each task')
+
+    parser.add_argument(
+        '--trace',
+        help='file to write the run to as Chrome trace events, for '
+        'chrome://tracing or Perfetto')
+
+    parser.add_argument(
+        '--logs',
+        help='directory to capture each repo\'s command output to, as '
+        '<repo>.log, instead of the terminal')
+    parser.add_argument(
+        '--live', action='store_true',
+        help='stream command output to the terminal, each line prefixed '
+        'with its [repo]')
+    parser.add_argument(
+        '--tail', type=int, default=20,
+        help='lines of captured output to show for a failed step')
+
+    parser.add_argument(
+        '--step_timeout', type=float,
+        help='seconds a step gets before its commands are killed')
+    parser.add_argument(
+        '--run_timeout', type=float,
+        help='seconds the whole run gets before what\'s still going is '
+        'killed')
+    parser.add_argument(
+        '--auto_timeouts', action='store_true',
+        help='time each step out at a multiple of how long it has taken '
+        'that repo, going by --journal')
+
     args = parser.parse_args()
-    main(args)
+    if (args.resume or args.rerun_failed) and not args.journal:
+        parser.error('--resume and --rerun_failed need --journal')
+    if args.auto_timeouts and not args.journal:
+        parser.error('--auto_timeouts needs --journal')
+    sys.exit(main(args))
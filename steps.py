@@ -1,76 +1,301 @@
-import subprocess
+import asyncio
+import os
 
-import requests
+from engine import (
+    run_sync, call, children, sink, unattended, in_thread, note, Lanes)
+from github import IGNORED_CONTEXTS
+from timing import StepTiming
+from vestore import update_in_place
+
+# resource classes that steps are scheduled on
+NETWORK = 'network'
+CPU = 'cpu'
+PUBLISH = 'publish'
+LOCAL = 'local'
+
+
+def classify(cmd):
+    program = os.path.basename(cmd[0])
+    if program == 'make':
+        return CPU
+    if program == 'hub':
+        return PUBLISH
+    if program == 'git' and len(cmd) > 1:
+        if cmd[1] == 'push':
+            return PUBLISH
+        if cmd[1] in ('pull', 'fetch', 'clone'):
+            return NETWORK
+    return LOCAL
 
 
 class Step(object):
-    def __init__(self, cmd, label, upgrader, skip_fail='fail'):
+    # an `always` step runs even after the task has failed or been
+    # skipped, eg. to clean up; it can't change the outcome then.
+    always = False
+    # the StepTiming of its last run
+    timing = None
+    # the last lines its commands printed, if it failed and they were
+    # captured (see logs.LogCapture)
+    tail = ()
+    # the timeout its last run was cut off at, if it was (see
+    # timeouts.Timeouts)
+    timed_out = None
+    # what its last run raised, if anything
+    error = None
+
+    def __init__(self, cmd, label, upgrader, skip_fail='fail', cwd=None,
+                 resource=None, always=False):
         self.upgrader = upgrader
         self.cmd = cmd
         self.label = label
         self.skip_fail = skip_fail
+        self.cwd = cwd
+        if resource is None and not callable(cmd):
+            resource = classify(cmd)
+        self.resource = resource
+        self.always = always
 
     def fail(self):
-        if self.skip_fail == 'fail':
-            self.upgrader.fail(self.label)
+        # a step that hung or broke is a failure even where its failing
+        # wouldn't be
+        if (self.skip_fail == 'fail' or self.timed_out is not None or
+                self.error is not None):
+            self.upgrader.fail(self.failure(), self.tail)
         else:
             self.upgrader.skip()
 
+    def failure(self):
+        if self.error is not None:
+            return '%s (%s)' % (self.label, self.error)
+        if self.timed_out is None:
+            return self.label
+        if self.timed_out <= 0:
+            return '%s (past the run deadline)' % self.label
+        # whole seconds, except for the ones too short to round
+        seconds = '%.1fs' if self.timed_out < 10 else '%.0fs'
+        return ('%s (timed out after ' + seconds + ')') % (
+            self.label, self.timed_out)
+
     def run(self):
-        if self.upgrader.status == 'failed':
+        run_sync(self.run_async())
+
+    def finished(self):
+        return self.upgrader.status in ('failed', 'skipped', 'cancelled')
+
+    async def run_async(self):
+        if self.finished() and not self.always:
             return
-        if self.upgrader.status == 'skipped':
+        if self.finished():
+            await self.measure()
             return
 
-        ret = self.execute()
+        resource = self.resource or classify(self.command())
+        async with self.lanes().lane(resource):
+            ret = await self.measure()
 
         if ret:
-            if self.skip_fail == 'fail':
-                self.upgrader.fail(self.label)
-            else:
-                self.upgrader.skip()
+            self.fail()
+
+    async def measure(self):
+        # execute_async(), keeping how long it took and what its commands
+        # used on the task
+        timing = StepTiming(self.label, self.command(), self.resource)
+        out = None
+        if self.upgrader.logs is not None:
+            out = self.upgrader.logs.start(self.upgrader, self)
+        # a command that can be timed out can't be left to prompt
+        tokens = (children.set(timing), sink.set(out), unattended.set(
+            unattended.get() or self.upgrader.timeouts is not None))
+        self.error = None
+        try:
+            ret = await self.execute_within()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # eg. the API unreachable or a bad replacement: like a command
+            # that couldn't be started, that's this step failing, not the
+            # whole run
+            self.error = '%s: %s' % (type(e).__name__, e)
+            self.say('%s: %s' % (self.label, self.error))
+            ret = 1
+        finally:
+            children.reset(tokens[0])
+            sink.reset(tokens[1])
+            unattended.reset(tokens[2])
+            if out is not None:
+                out.close()
+        if ret and out is not None:
+            self.tail = out.tail()
+        timing.finish(ret)
+        self.timing = timing
+        self.upgrader.timings.append(timing)
+        return ret
+
+    async def execute_within(self):
+        # execute_async(), cut off at the task's timeout for the step
+        self.timed_out = None
+        timeout = None
+        if self.upgrader.timeouts is not None:
+            timeout = self.upgrader.timeouts.timeout(self.upgrader, self)
+        if timeout is None:
+            return await self.execute_async()
+        if timeout > 0:
+            try:
+                return await asyncio.wait_for(self.execute_async(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.timed_out = timeout
+        self.say(self.failure())
+        return 1
+
+    def say(self, message):
+        # see engine.note; the repo's name says which of the tasks in
+        # flight it's about
+        note('%s: %s' % (self.upgrader.repo, message))
+
+    def lanes(self):
+        return self.upgrader.lanes or Lanes()
+
+    def working_dir(self):
+        return self.cwd or self.upgrader.working_dir()
+
+    def environ(self):
+        # the task's env adds to (rather than replaces) our own
+        if not self.upgrader.env:
+            return None
+        env = dict(os.environ)
+        env.update(self.upgrader.env)
+        return env
+
+    def command(self):
+        # cmd can be a callable, for a command that depends on what the
+        # steps before it did
+        if callable(self.cmd):
+            return self.cmd()
+        return self.cmd
 
     def execute(self):
-        return subprocess.call(self.cmd)
+        return run_sync(self.execute_async())
 
+    async def execute_async(self):
+        return await call(
+            self.command(), cwd=self.working_dir(), env=self.environ())
 
-class CommitStatusStep(Step):
 
-    def __init__(self, label, upgrader, skip_fail='fail'):
+class CachedMakeStep(Step):
+    # `make`, skipped when the task's ResultCache has seen the same build
+    # succeed
+
+    async def execute_async(self):
+        cache = self.upgrader.result_cache
+        key = await cache.key(
+            self.working_dir(), self.upgrader.requirements_path(),
+            self.command(), self.environ())
+        if cache.hit(key):
+            self.say('%s: already passed for this tree' % self.label)
+            return 0
+        ret = await Step.execute_async(self)
+        cache.record(key, ret)
+        return ret
+
+
+class FunctionStep(Step):
+    # runs a python callable in-process instead of forking a command. the
+    # callable returns a true value on failure, like an exit status.
+
+    def __init__(self, func, label, upgrader, skip_fail='fail',
+                 resource=LOCAL):
         self.upgrader = upgrader
+        self.func = func
+        self.cmd = None
         self.label = label
         self.skip_fail = skip_fail
+        self.cwd = None
+        self.resource = resource
 
     def execute(self):
-        url = '{}/{}/{}/commits/{}/status'.format(
-            self.upgrader.git_base, self.upgrader.owner,
-            self.upgrader.repo, self.upgrader.pattern)
+        return self.func()
+
+    async def execute_async(self):
+        return self.execute()
+
+
+class VirtualenvStoreStep(Step):
+    # puts a ve built from the task's requirements.txt in place from the
+    # task's VirtualenvStore, building it there first if need be
+
+    def __init__(self, label, upgrader, skip_fail='fail'):
+        self.upgrader = upgrader
+        self.cmd = None
+        self.label = label
+        self.skip_fail = skip_fail
+        self.cwd = None
+        self.resource = CPU
+
+    async def execute_async(self):
+        return await self.upgrader.ve_store.provide(
+            self.working_dir(), self.upgrader.requirements_path(),
+            self.environ())
+
+
+class IncrementalVirtualenvStep(VirtualenvStoreStep):
+    # installs only the pins the task's search/replace changed into the
+    # existing ve
+
+    async def execute_async(self):
+        return await update_in_place(
+            self.working_dir(), self.upgrader.requirements_path(),
+            self.upgrader.changes, self.environ())
+
+
+class ApiStep(Step):
+    # talks to the Github API through the task's shared client; the
+    # blocking execute() runs on the client's worker pool so it doesn't
+    # hold up the event loop
+
+    resource = NETWORK
+
+    def __init__(self, label, upgrader, skip_fail='fail'):
+        self.upgrader = upgrader
+        self.cmd = None
+        self.label = label
+        self.skip_fail = skip_fail
+        self.cwd = None
+
+    async def execute_async(self):
+        return await in_thread(
+            self.execute, executor=self.upgrader.client.executor)
+
+    def path(self, *parts):
+        return '/'.join(
+            ['/repos', self.upgrader.owner, self.upgrader.repo] +
+            [str(p) for p in parts])
 
-        response = requests.get(url, headers=self.upgrader.headers)
+
+class CommitStatusStep(ApiStep):
+
+    def execute(self):
+        response = self.upgrader.client.get(
+            self.path('commits', self.upgrader.pattern, 'status'))
         if response.status_code != 200:
             return 1
 
         the_json = response.json()
         for status in the_json['statuses']:
             # ignore pyup safety warnings
-            if status['context'] == 'pyup.io/safety-ci':
+            if status['context'] in IGNORED_CONTEXTS:
                 continue
             if status['state'] == 'failure':
                 return 1
 
 
-class PullRequestStep(Step):
-
-    def __init__(self, label, upgrader, skip_fail='fail'):
-        self.upgrader = upgrader
-        self.label = label
-        self.skip_fail = skip_fail
+class PullRequestStep(ApiStep):
 
     def execute(self):
-        url = '{}/{}/{}/pulls'.format(
-            self.upgrader.git_base, self.upgrader.owner, self.upgrader.repo)
-
-        response = requests.get(url, headers=self.upgrader.headers)
+        # filter on the branch so the PR isn't lost past the first page
+        head = '{}:{}'.format(self.upgrader.owner, self.upgrader.pattern)
+        response = self.upgrader.client.get(
+            self.path('pulls'), params={'head': head, 'state': 'open'})
         if response.status_code != 200:
             return 1
 
@@ -82,18 +307,66 @@ class PullRequestStep(Step):
         return 1
 
 
-class MergeStep(Step):
+class MergeStep(ApiStep):
+    resource = PUBLISH
 
-    def __init__(self, label, upgrader, skip_fail='fail'):
-        self.upgrader = upgrader
-        self.label = label
-        self.skip_fail = skip_fail
+    def execute(self):
+        response = self.upgrader.client.put(
+            self.path('pulls', self.upgrader.number, 'merge'))
+        if response.status_code != 200:
+            return 1
+
+
+class LookupStep(ApiStep):
+    # checks the result of github.lookup_pull_requests instead of making
+    # its own API call
+    resource = LOCAL
+
+    async def execute_async(self):
+        return self.execute()
+
+    def info(self):
+        return self.upgrader.lookups[self.upgrader.repo]
+
+
+class LookupStatusStep(LookupStep):
 
     def execute(self):
-        url = '{}/{}/{}/pulls/{}/merge'.format(
-            self.upgrader.git_base, self.upgrader.owner,
-            self.upgrader.repo, self.upgrader.number)
+        info = self.info()
+        if info is not None and info['failing']:
+            return 1
 
-        response = requests.put(url, headers=self.upgrader.headers)
-        if response.status_code != 200:
+
+class LookupPullRequestStep(LookupStep):
+
+    def execute(self):
+        info = self.info()
+        if info is None or info['mergeable'] == 'CONFLICTING':
             return 1
+        self.upgrader.number = info['number']
+
+
+class RemoveWorktreeStep(Step):
+    # `git worktree remove` of the task's worktree; just the empty
+    # directory made for it if `git worktree add` failed, and nothing if
+    # it never got that far
+
+    def __init__(self, label, upgrader, cwd=None):
+        Step.__init__(self, None, label, upgrader, cwd=cwd,
+                      resource=LOCAL, always=True)
+
+    def command(self):
+        if self.upgrader.worktree is None:
+            return None
+        return ['git', 'worktree', 'remove', '--force',
+                self.upgrader.worktree]
+
+    async def execute_async(self):
+        worktree = self.upgrader.worktree
+        if worktree is None:
+            return 0
+        if not os.path.exists(os.path.join(worktree, '.git')):
+            if os.path.isdir(worktree):
+                os.rmdir(worktree)
+            return 0
+        return await Step.execute_async(self)
@@ -1,29 +1,161 @@
+import asyncio
 import os
+import threading
+import time
 
-from steps import Step, CommitStatusStep, PullRequestStep, MergeStep
+import requirements
+from engine import run_sync, gather_bounded, Lanes
+from github import GithubClient, API_BASE
+from logs import print_tail
+from mirrors import REMOTE, ORIGIN_REFSPEC
+from steps import (
+    Step, CachedMakeStep, FunctionStep, CommitStatusStep, PullRequestStep,
+    MergeStep, LookupStatusStep, LookupPullRequestStep, VirtualenvStoreStep)
+from timing import print_timings
 
 
 class Task(object):
+    lanes = None
+    env = None
+    ve_store = None
+    incremental = False
+    result_cache = None
+    worktrees = None
+    remote = REMOTE
+    mirrors = None
+    clone_filter = None
+    clone_depth = None
+    journal = None
+    report = None
+    trace = None
+    logs = None
+    timeouts = None
+    changes = ()
+    tail = ()
 
     def full_repo_path(self):
         return os.path.join(self.base, self.repo)
 
+    def working_dir(self):
+        return self.full_repo_path()
+
     def requirements_path(self):
         return os.path.join(self.base, self.repo, 'requirements.txt')
 
     def package_json_path(self):
         return os.path.join(self.base, self.repo, 'package.json')
 
-    def replace_pattern(self):
-        return 's/%s/%s/' % (self.match, self.replace)
-
-    def fail(self, msg):
+    def replacement(self):
+        return requirements.compile_replacement(self.match, self.replace)
+
+    def match_requirements(self):
+        # skipped unless the replacement would change something, so that
+        # a repo that's already upgraded never gets a branch
+        text = requirements.read(self.requirements_path())
+        if text is None or not self.replacement().preview(text):
+            return 1
+
+    def replace_requirements(self):
+        # a replacement that changes nothing would otherwise only be
+        # noticed when `git commit` fails, after a full build
+        self.changes = requirements.rewrite(
+            self.requirements_path(), self.replacement())
+        if not self.changes:
+            return 1
+
+    def fetch_step(self, cwd=None):
+        # from origin when the repo has no mirror
+        if self.mirrors is not None and self.mirrors.has(self.repo):
+            return Step(['git', 'fetch', '--prune',
+                         self.mirrors.mirror_path(self.repo),
+                         ORIGIN_REFSPEC], 'git fetch', self, cwd=cwd)
+        return Step(['git', 'fetch', 'origin'], 'git fetch', self, cwd=cwd)
+
+    def pull_steps(self):
+        # `git pull`, or with a mirror cache, its fetch from the mirror
+        # followed by the merge
+        if self.mirrors is not None:
+            return [self.fetch_step(),
+                    Step(['git', 'merge', '--no-edit', '@{upstream}'],
+                         'git pull', self)]
+        return [Step(['git', 'pull'], 'git pull', self)]
+
+    def make_step(self):
+        if self.result_cache is not None:
+            return CachedMakeStep(['make'], 'make', self)
+        return Step(['make'], 'make', self)
+
+    def virtualenv_steps(self):
+        # to run just before `make`
+        if self.ve_store is not None:
+            return [VirtualenvStoreStep('virtualenv', self)]
+        return []
+
+    def fail(self, msg, tail=()):
         self.status = 'failed'
         self.log = msg
+        self.tail = list(tail)
 
     def skip(self):
         self.status = 'skipped'
 
+    def cancel(self, msg):
+        self.status = 'cancelled'
+        self.log = msg
+
+    def steps(self):
+        return []
+
+    def make(self):
+        return run_sync(self.make_async())
+
+    async def make_async(self):
+        await self.run_steps_async(self.steps())
+
+    def run_steps(self, steps):
+        return run_sync(self.run_steps_async(steps))
+
+    def resumable(self):
+        # whether a run cut off part way through can carry on from the
+        # step it got to, rather than starting over
+        return True
+
+    async def run_steps_async(self, steps):
+        print('====== %s =======' % self.repo)
+        started = time.time()
+        done = 0
+        if self.journal is not None:
+            (done, status) = self.journal.resume_point(self, steps)
+            if status is not None:
+                print('already %s' % status)
+                self.status = status
+                return
+            self.journal.started(self, done)
+        if self.trace is not None:
+            self.trace.started(self)
+        for (i, s) in enumerate(steps):
+            if i < done:
+                continue
+            try:
+                await s.run_async()
+            except asyncio.CancelledError:
+                # Ctrl-C (see engine.run_sync): its commands have been
+                # killed, and the `always` steps still get to clean up
+                self.cancel(s.label)
+                continue
+            if self.report is not None and s.timing is not None:
+                self.report.step(self, s)
+            if self.journal is not None and not s.finished():
+                self.journal.step_done(self, i, s)
+        if self.status == 'running':
+            self.status = 'success'
+        if self.journal is not None:
+            self.journal.finished(self)
+        if self.report is not None:
+            self.report.repo(self, started)
+        if self.trace is not None:
+            self.trace.finished(self)
+
 
 class CloneTask(Task):
     def __init__(self, base, repo):
@@ -31,24 +163,29 @@ class CloneTask(Task):
         self.repo = repo
         self.status = 'running'
         self.log = ''
-
-    def make(self):
-        print('====== %s =======' % self.repo)
-        os.chdir(self.base)
-
-        gitref = 'git@github.com:ccnmtl/{}.git'.format(self.repo)
-
-        steps = [Step(
-            ['git', 'clone', gitref],
-            'git clone {}'.format(gitref),
+        self.timings = []
+
+    def working_dir(self):
+        return self.base
+
+    def steps(self):
+        gitref = self.remote.format(self.repo)
+
+        options = []
+        if self.mirrors is not None:
+            # and without, if the mirror couldn't be made
+            options.extend(
+                ['--reference-if-able', self.mirrors.mirror_path(self.repo)])
+        if self.clone_filter:
+            options.append('--filter={}'.format(self.clone_filter))
+        if self.clone_depth:
+            options.extend(['--depth', str(self.clone_depth)])
+
+        return [Step(
+            ['git', 'clone'] + options + [gitref],
+            'git clone',
             self)]
 
-        for s in steps:
-            s.run()
-        if self.status != 'failed' and self.status != 'skipped':
-            self.status = 'success'
-        return
-
 
 class CheckoutTask(Task):
     def __init__(self, base, repo, branch):
@@ -57,25 +194,17 @@ class CheckoutTask(Task):
         self.branch = branch
         self.status = 'running'
         self.log = ''
+        self.timings = []
 
-    def make(self):
-        print('====== %s =======' % self.repo)
-        os.chdir(self.full_repo_path())
-
+    def steps(self):
         steps = [
             Step(['git', 'checkout', self.branch],
                  'git checkout {}'.format(self.branch),
                  self),
             Step(['git', 'reset', '--hard'], 'git reset --hard',
                  self),
-            Step(['git', 'pull'], 'git pull', self),
         ]
-
-        for s in steps:
-            s.run()
-        if self.status != 'failed' and self.status != 'skipped':
-            self.status = 'success'
-        return
+        return steps + self.pull_steps()
 
 
 class NewBranchTask(Task):
@@ -85,27 +214,20 @@ class NewBranchTask(Task):
         self.branch = branch
         self.status = 'running'
         self.log = ''
+        self.timings = []
 
-    def make(self):
-        print('====== %s =======' % self.repo)
-        os.chdir(self.full_repo_path())
-
+    def steps(self):
         steps = [
             Step(['git', 'checkout', 'master'],
                  'git checkout master', self),
             Step(['git', 'reset', '--hard'],
                  'git reset --hard', self),
-            Step(['git', 'pull'],
-                 'git pull', self),
-            Step(['git', 'checkout', '-b', self.branch],
-                 'create new branch', self),
             ]
-
-        for s in steps:
-            s.run()
-        if self.status != 'failed' and self.status != 'skipped':
-            self.status = 'success'
-        return
+        steps.extend(self.pull_steps())
+        steps.append(
+            Step(['git', 'checkout', '-b', self.branch],
+                 'create new branch', self))
+        return steps
 
 
 class MakeTask(Task):
@@ -114,17 +236,10 @@ class MakeTask(Task):
         self.repo = repo
         self.status = 'running'
         self.log = ''
+        self.timings = []
 
-    def make(self):
-        print('====== %s =======' % self.repo)
-        os.chdir(self.full_repo_path())
-        steps = [Step(['make'], 'make', self)]
-
-        for s in steps:
-            s.run()
-        if self.status != 'failed' and self.status != 'skipped':
-            self.status = 'success'
-        return
+    def steps(self):
+        return self.virtualenv_steps() + [self.make_step()]
 
 
 class StatusTask(Task):
@@ -133,22 +248,14 @@ class StatusTask(Task):
         self.repo = repo
         self.status = 'running'
         self.log = ''
+        self.timings = []
 
-    def make(self):
-        print('====== %s =======' % self.repo)
-        os.chdir(self.full_repo_path())
-
-        steps = [
+    def steps(self):
+        return [
             Step(['git', 'status'],
                  'git status', self),
             ]
 
-        for s in steps:
-            s.run()
-        if self.status != 'failed' and self.status != 'skipped':
-            self.status = 'success'
-        return
-
 
 class CommitAndPushTask(Task):
     def __init__(self, base, repo, branch, message):
@@ -158,14 +265,10 @@ class CommitAndPushTask(Task):
         self.message = message
         self.status = 'running'
         self.log = ''
+        self.timings = []
 
-    def make(self):
-        print('====== %s =======' % self.repo)
-        os.chdir(self.full_repo_path())
-
-        print(self.full_repo_path())
-
-        steps = [
+    def steps(self):
+        return [
             Step(['git', 'checkout', self.branch],
                  'set branch', self),
             Step(['git', 'commit', '-a', '-m', self.message],
@@ -174,12 +277,6 @@ class CommitAndPushTask(Task):
                  'push changes', self),
             ]
 
-        for s in steps:
-            s.run()
-        if self.status != 'failed' and self.status != 'skipped':
-            self.status = 'success'
-        return
-
 
 class PublishTask(Task):
     def __init__(self, base, repo):
@@ -187,23 +284,15 @@ class PublishTask(Task):
         self.repo = repo
         self.status = 'running'
         self.log = ''
+        self.timings = []
 
-    def make(self):
-        print('====== %s =======' % self.repo)
-        os.chdir(self.full_repo_path())
-
-        steps = [
+    def steps(self):
+        return [
             Step(['make', 'publish'],
                  'make publish',
                  self),
         ]
 
-        for s in steps:
-            s.run()
-        if self.status != 'failed' and self.status != 'skipped':
-            self.status = 'success'
-        return
-
 
 class RequirementsUpdateTask(Task):
     def __init__(self, base, repo, match, replace):
@@ -213,71 +302,120 @@ class RequirementsUpdateTask(Task):
         self.replace = replace
         self.status = 'running'
         self.log = ''
+        self.timings = []
 
-    def make(self):
-        print('====== %s =======' % self.repo)
-        os.chdir(self.full_repo_path())
-
-        steps = [
-            Step(['perl', '-pi', '-e', self.replace_pattern(),
-                 self.requirements_path()], 'search/replace',
-                 self)
+    def steps(self):
+        return [
+            FunctionStep(self.replace_requirements, 'search/replace',
+                         self, skip_fail='skip')
         ]
 
-        for s in steps:
-            s.run()
-        if self.status != 'failed' and self.status != 'skipped':
-            self.status = 'success'
-        return
-
 
 class MergeMatchingPullRequestTask(Task):
 
-    def __init__(self, base, repo, owner, pattern, api_token):
+    def __init__(self, base, repo, owner, pattern, api_token, client=None,
+                 lookups=None, api_base=API_BASE):
         self.base = base
         self.repo = repo
         self.owner = owner
         self.pattern = pattern
         self.status = 'running'
-        self.headers = {'Authorization': 'token %s' % api_token}
+        self.client = client or GithubClient(api_token, api_base)
+        self.lookups = lookups
         self.log = ''
-        self.git_base = 'https://api.github.com/repos'
-
-    def make(self):
-        print('====== %s =======' % self.repo)
-        os.chdir(self.full_repo_path())
-
-        steps = [
+        self.timings = []
+
+    def steps(self):
+        if self.lookups is not None and self.repo in self.lookups:
+            return [
+                LookupStatusStep('commit status', self),
+                LookupPullRequestStep('pull request info', self),
+                MergeStep('merge the pr', self)
+            ]
+        return [
             CommitStatusStep('commit status', self),
             PullRequestStep('pull request info', self),
             MergeStep('merge the pr', self)
         ]
 
-        for s in steps:
-            s.run()
-        if self.status != 'failed' and self.status != 'skipped':
-            self.status = 'success'
+
+def cancel_unstarted(tasks):
+    # after a Ctrl-C, the tasks that it stopped from getting going
+    unstarted = [t for t in tasks if t.status == 'running']
+    for t in unstarted:
+        t.cancel('not started')
+        # so that --rerun-failed picks them up
+        if t.journal is not None:
+            t.journal.finished(t)
+    return unstarted
+
+
+def configure(task, settings):
+    for (name, value) in settings.items():
+        if value is not None:
+            setattr(task, name, value)
 
 
 class TaskRunner(object):
-    failed = []
-    skipped = []
-    succeeded = []
+    def __init__(self, **settings):
+        # settings are attributes given to every task run, eg. env
+        self.settings = settings
+        self.failed = []
+        self.skipped = []
+        self.succeeded = []
+        self.cancelled = []
+        # whether a Ctrl-C cut the run short
+        self.interrupted = False
+        self.timings = []
+        self.tails = {}
+        self.lock = threading.Lock()
 
     def run(self, task):
         task.make()
-        if task.status == 'failed':
-            self.failed.append((task.repo, task.log))
-        elif task.status == 'skipped':
-            self.skipped.append(task.repo)
-        else:
-            self.succeeded.append(task.repo)
+        self.record(task)
+
+    async def run_async(self, task):
+        await task.make_async()
+        self.record(task)
+
+    def run_all(self, tasks, jobs=1, lanes=None):
+        run_sync(self.run_all_async(tasks, jobs, lanes))
+
+    async def run_all_async(self, tasks, jobs=1, lanes=None):
+        # lanes maps resource class to limit, eg. {'cpu': 2}; tasks share
+        # them so one repo's network steps overlap with another's build
+        shared = Lanes(lanes)
+        tasks = list(tasks)
+        for t in tasks:
+            t.lanes = shared
+            configure(t, self.settings)
+        try:
+            await gather_bounded([self.run_async(t) for t in tasks], jobs)
+        except asyncio.CancelledError:
+            self.interrupted = True
+            for t in cancel_unstarted(tasks):
+                self.record(t)
+
+    def record(self, task):
+        with self.lock:
+            self.timings.extend(task.timings)
+            if task.status == 'failed':
+                self.failed.append((task.repo, task.log))
+                self.tails[task.repo] = task.tail
+            elif task.status == 'skipped':
+                self.skipped.append(task.repo)
+            elif task.status == 'cancelled':
+                self.cancelled.append((task.repo, task.log))
+            else:
+                self.succeeded.append(task.repo)
 
     def print_report(self):
         print('===============================================')
         print('failed: %d' % len(self.failed))
         print('skipped: %d' % len(self.skipped))
         print('succeeded: %d' % len(self.succeeded))
+        if len(self.cancelled) > 0:
+            print('cancelled: %d' % len(self.cancelled))
         if len(self.skipped) > 0:
             print('SKIPPED:')
             for s in self.skipped:
@@ -286,8 +424,19 @@ class TaskRunner(object):
             print('FAILED:')
             for (r, msg) in self.failed:
                 print('\t%s: %s' % (r, msg))
+                print_tail(self.tails.get(r))
+        if len(self.cancelled) > 0:
+            print('CANCELLED:')
+            for (r, msg) in self.cancelled:
+                print('\t%s: %s' % (r, msg))
         if len(self.succeeded) > 0:
             print('SUCCEEDED:')
             for r in self.succeeded:
                 print('\t%s' % r)
         print('===============================================')
+        print_timings(self.timings)
+        report = self.settings.get('report')
+        if report is not None:
+            report.summary(
+                self.failed, self.skipped, self.succeeded, self.timings,
+                self.cancelled)
@@ -0,0 +1,37 @@
+import time
+
+from timing import percentile
+
+# a timeout learned from the journal is FACTOR times the p99 of how long
+# the step took for that repo before, but never under MINIMUM seconds,
+# and only once there are SAMPLES earlier runs of it to go on
+FACTOR = 3
+MINIMUM = 60
+SAMPLES = 5
+
+
+class Timeouts(object):
+    # how long a step gets before its commands are killed: `step`
+    # seconds, or with learn, a timeout worked out from the journal's
+    # record of that step in that repo; and, except for the `always`
+    # steps that clean up, nothing past the deadline of `run` seconds
+    # from now for the whole run
+
+    def __init__(self, step=None, run=None, journal=None, learn=False):
+        self.step = step
+        self.deadline = time.monotonic() + run if run else None
+        self.journal = journal if learn else None
+
+    def learned(self, repo, label):
+        walls = self.journal.durations(repo, label) if self.journal else ()
+        if len(walls) < SAMPLES:
+            return None
+        return max(FACTOR * percentile(walls, 99), MINIMUM)
+
+    def timeout(self, task, step):
+        # in seconds, or None for no limit
+        timeout = self.learned(task.repo, step.label) or self.step
+        if self.deadline is not None and not step.always:
+            left = self.deadline - time.monotonic()
+            timeout = left if timeout is None else min(timeout, left)
+        return timeout
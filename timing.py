@@ -0,0 +1,100 @@
+import math
+import sys
+import time
+
+PERCENTILES = (50, 90, 99)
+
+
+def rss_mb(maxrss):
+    # ru_maxrss is in kilobytes, except on macOS where it's bytes
+    if sys.platform == 'darwin':
+        return maxrss / (1024.0 * 1024)
+    return maxrss / 1024.0
+
+
+def percentile(values, p):
+    # nearest rank, so it's always one of the values
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class StepTiming(object):
+    # how long one step took, and the cpu time and peak memory of the
+    # commands it ran (see engine.children)
+
+    def __init__(self, label, cmd=None, resource=None):
+        self.label = label
+        self.cmd = cmd
+        self.resource = resource
+        self.started = time.time()
+        self.clock = time.monotonic()
+        self.wall = 0.0
+        self.user = 0.0
+        self.sys = 0.0
+        self.maxrss = 0
+        self.returncode = None
+
+    def add_rusage(self, rusage):
+        self.user += rusage.ru_utime
+        self.sys += rusage.ru_stime
+        self.maxrss = max(self.maxrss, rusage.ru_maxrss)
+
+    def finish(self, returncode):
+        self.wall = time.monotonic() - self.clock
+        self.returncode = returncode
+
+    def as_dict(self):
+        return {
+            'label': self.label,
+            'cmd': self.cmd,
+            'resource': self.resource,
+            'started': self.started,
+            'wall': self.wall,
+            'user': self.user,
+            'sys': self.sys,
+            'maxrss_mb': rss_mb(self.maxrss),
+            'returncode': self.returncode,
+        }
+
+
+def by_label(timings):
+    # {step label: [StepTiming, ...]}, in the order labels first appear
+    grouped = {}
+    for t in timings:
+        grouped.setdefault(t.label, []).append(t)
+    return grouped
+
+
+def summarize(timings):
+    summary = {}
+    for (label, group) in by_label(timings).items():
+        walls = [t.wall for t in group]
+        row = {'count': len(group),
+               'total': sum(walls),
+               'max': max(walls),
+               'user': sum(t.user for t in group),
+               'sys': sum(t.sys for t in group),
+               'maxrss_mb': rss_mb(max(t.maxrss for t in group))}
+        for p in PERCENTILES:
+            row['p%d' % p] = percentile(walls, p)
+        summary[label] = row
+    return summary
+
+
+def print_timings(timings):
+    summary = summarize(timings)
+    if not summary:
+        return
+    header = ['n', 'total'] + ['p%d' % p for p in PERCENTILES] + [
+        'max', 'user', 'sys']
+    print('%-28s' % 'step' +
+          ''.join('%9s' % h for h in header) + '%9s' % 'rss(MB)')
+    rows = sorted(summary.items(), key=lambda i: -i[1]['total'])
+    for (label, row) in rows:
+        print('%-28s' % label[:28] +
+              '%9d' % row['count'] +
+              ''.join('%8.1fs' % row[h] for h in header[1:]) +
+              '%9.0f' % row['maxrss_mb'])
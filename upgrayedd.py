@@ -1,63 +1,100 @@
 #!/usr/bin/env python
 
-import subprocess
 import argparse
+import asyncio
 import os
+import re
+import sys
+import tempfile
 
+from chrometrace import ChromeTrace
+from engine import run_sync, gather_bounded, Lanes
+from journal import Journal
+from logs import LogCapture, print_tail
+from mirrors import MirrorCache, REMOTE
+from report import Report
+from reqindex import select_repos
+from requirements import (
+    compile_replacement, read, load_manifest, ReplacementSet)
+from resultcache import ResultCache
+from steps import (
+    Step, FunctionStep, IncrementalVirtualenvStep, RemoveWorktreeStep,
+    NETWORK, CPU, PUBLISH)
+from tasks import Task, configure, cancel_unstarted
+from timeouts import Timeouts
+from timing import print_timings
+from vestore import VirtualenvStore
+from wheelhouse import start_wheelhouse
 
-class Step(object):
-    def __init__(self, cmd, label, upgrader, skip_fail="fail"):
-        self.upgrader = upgrader
-        self.cmd = cmd
-        self.label = label
-        self.skip_fail = skip_fail
 
-    def run(self):
-        if self.upgrader.status == "failed":
-            return
-        if self.upgrader.status == "skipped":
-            return
-        ret = subprocess.call(self.cmd)
-        if ret:
-            if self.skip_fail == "fail":
-                self.upgrader.fail(self.label)
-            else:
-                self.upgrader.skip()
+def worktree_path(scratch, repo, branch):
+    # a fresh, empty directory per worktree; git is happy to add a
+    # worktree in an empty directory
+    if not os.path.isdir(scratch):
+        os.makedirs(scratch)
+    prefix = "%s-%s-" % (repo, re.sub(r"[^A-Za-z0-9._-]+", "_", branch))
+    return tempfile.mkdtemp(prefix=prefix, dir=os.path.abspath(scratch))
 
 
-class UBase(object):
-    def full_repo_path(self):
-        return os.path.join(self.base, self.repo)
-
-    def requirements_path(self):
-        return os.path.join(self.base, self.repo, "requirements.txt")
-
-    def replace_pattern(self):
-        return "s/%s/%s/" % (self.match, self.replace)
-
-    def fail(self, msg):
-        self.status = "failed"
-        self.log = msg
-
-    def skip(self):
-        self.status = "skipped"
-
-
-class Upgrader(UBase):
-    def __init__(self, base, repo, branch, match, replace, message, hub):
+class Upgrader(Task):
+    def __init__(self, base, repo, branch, match, replace, message, hub,
+                 manifest=None):
         self.base = base
         self.repo = repo
         self.branch = branch
         self.match = match
         self.replace = replace
+        self.manifest = manifest
         self.hub = hub
         self.message = message
+        self.changes = []
+        self.worktree = None
         self.status = "running"
         self.log = ""
+        self.timings = []
+
+    def working_dir(self):
+        return self.worktree or self.full_repo_path()
+
+    def requirements_path(self):
+        return os.path.join(self.working_dir(), "requirements.txt")
+
+    def replacement(self):
+        if self.manifest:
+            return ReplacementSet(
+                [compile_replacement(m, r) for (m, r) in self.manifest])
+        return Task.replacement(self)
+
+    def virtualenv_steps(self):
+        # only an upgrade updates the ve in place; a plain make leaves it
+        # to the Makefile
+        if self.incremental and self.ve_store is None:
+            return [IncrementalVirtualenvStep("update virtualenv", self)]
+        return Task.virtualenv_steps(self)
+
+    def commit_message(self):
+        if self.message:
+            return self.message
+        return ":arrow_up: " + ", ".join(
+            new.strip() for (old, new) in self.changes)
+
+    def commit_command(self):
+        return ["git", "commit", "-a", "-m", self.commit_message()]
+
+    def pull_request_command(self):
+        return [self.hub, "pull-request", "-m", self.commit_message()]
+
+    def resumable(self):
+        # a worktree is thrown away with the run, so start over in a new
+        # one
+        return not self.worktrees
 
     def upgrade(self, reset=False):
-        print("====== %s =======" % self.repo)
-        os.chdir(self.full_repo_path())
+        self.run_steps(self.upgrade_steps(reset))
+
+    def upgrade_steps(self, reset=False):
+        if self.worktrees:
+            return self.worktree_steps()
         steps = [
             Step(["git", "checkout", "master"],
                  "git checkout master", self)]
@@ -65,99 +102,102 @@ class Upgrader(UBase):
             steps.append(
                 Step(["git", "reset", "--hard"], "git reset --hard",
                      self))
+        steps.extend(self.pull_steps())
         steps.extend([
-            Step(["git", "pull"],
-                 "git pull", self),
-            Step(["grep", self.match, self.requirements_path()],
-                 "grep", self, skip_fail="skip"),
+            FunctionStep(self.match_requirements,
+                         "match", self, skip_fail="skip"),
             Step(["git", "checkout", "-b", self.branch],
                  "create new branch", self),
-            Step(["perl", "-pi", "-e", self.replace_pattern(),
-                  self.requirements_path()], "search/replace",
-                 self),
-            Step(["make"], "make", self),
-            Step(["git", "commit", "-a", "-m", self.message],
-                 "commit", self),
+            FunctionStep(self.replace_requirements, "search/replace",
+                         self)])
+        steps.extend(self.virtualenv_steps())
+        steps.extend([
+            self.make_step(),
+            Step(self.commit_command, "commit", self),
             Step(["git", "push", "origin", self.branch],
                  "push", self),
-            Step([self.hub,
-                  "pull-request", "-m", self.message],
-                 "pull request", self),
+            Step(self.pull_request_command, "pull request", self,
+                 resource=PUBLISH),
             Step(["git", "checkout", "master"], "reset to master",
                  self),
             ])
-        for s in steps:
-            s.run()
-        if self.status != "failed" and self.status != "skipped":
-            self.status = "success"
-        return
+        return steps
 
+    def worktree_add_command(self):
+        # the directory is only made once the worktree is about to be
+        # added, so there's none to leak if the upgrade never gets there
+        if self.worktree is None:
+            self.worktree = worktree_path(
+                self.worktrees, self.repo, self.branch)
+        return ["git", "worktree", "add", "--detach", self.worktree,
+                "origin/master"]
 
-class Updater(UBase):
+    def worktree_steps(self):
+        # the same upgrade in a throwaway worktree of origin/master, so
+        # the checkout in base is never touched and the same repo can
+        # be upgraded more than once at a time
+        repo = self.full_repo_path()
+        steps = [
+            self.fetch_step(cwd=repo),
+            Step(self.worktree_add_command, "create worktree", self,
+                 cwd=repo),
+            FunctionStep(self.match_requirements,
+                         "match", self, skip_fail="skip"),
+            Step(["git", "checkout", "-b", self.branch],
+                 "create new branch", self),
+            FunctionStep(self.replace_requirements, "search/replace",
+                         self)]
+        steps.extend(self.virtualenv_steps())
+        steps.extend([
+            self.make_step(),
+            Step(self.commit_command, "commit", self),
+            Step(["git", "push", "origin", self.branch],
+                 "push", self),
+            Step(self.pull_request_command, "pull request", self,
+                 resource=PUBLISH),
+            RemoveWorktreeStep("remove worktree", self, cwd=repo),
+            ])
+        return steps
+
+
+class Updater(Task):
     def __init__(self, base, repo):
         self.base = base
         self.repo = repo
         self.status = "running"
         self.log = ""
+        self.timings = []
 
     def upgrade(self, reset=False):
-        print("====== %s =======" % self.repo)
-        os.chdir(self.full_repo_path())
+        self.run_steps(self.upgrade_steps(reset))
+
+    def upgrade_steps(self, reset=False):
+        steps = [
+            Step(["git", "checkout", "master"],
+                 "git checkout master", self)]
         if reset:
-            steps = [
-                Step(["git", "checkout", "master"],
-                     "git checkout master", self),
+            steps.append(
                 Step(["git", "reset", "--hard"], "git reset --hard",
-                     self),
-                Step(["git", "pull"],
-                     "git pull", self),
-            ]
-        else:
-            steps = [
-                Step(["git", "checkout", "master"],
-                     "git checkout master", self),
-                Step(["git", "pull"],
-                     "git pull", self),
-            ]
-        for s in steps:
-            s.run()
-        if self.status != "failed" and self.status != "skipped":
-            self.status = "success"
-        return
+                     self))
+        steps.extend(self.pull_steps())
+        return steps
 
     def make(self, reset=False):
-        print("====== %s =======" % self.repo)
-        os.chdir(self.full_repo_path())
-        if reset:
-            steps = [
-                Step(["git", "checkout", "master"],
-                     "git checkout master", self),
-                Step(["git", "reset", "--hard"],
-                     "git reset --hard", self),
-                Step(["git", "pull"],
-                     "git pull", self),
-                Step(["make"], "make", self),
-                ]
-        else:
-            steps = [
-                Step(["git", "checkout", "master"],
-                     "git checkout master", self),
-                Step(["git", "pull"],
-                     "git pull", self),
-                Step(["make"], "make", self),
-                ]
-        for s in steps:
-            s.run()
-        if self.status != "failed" and self.status != "skipped":
-            self.status = "success"
-        return
+        self.run_steps(self.make_steps(reset))
+
+    def make_steps(self, reset=False):
+        return (self.upgrade_steps(reset) + self.virtualenv_steps() +
+                [self.make_step()])
 
 
-def print_report(failed, skipped, succeeded):
+def print_report(failed, skipped, succeeded, timings=(), tails=None,
+                 cancelled=()):
     print("===============================================")
     print("failed: %d" % len(failed))
     print("skipped: %d" % len(skipped))
     print("succeeded: %d" % len(succeeded))
+    if len(cancelled) > 0:
+        print("cancelled: %d" % len(cancelled))
     if len(skipped) > 0:
         print("SKIPPED:")
         for s in skipped:
@@ -166,37 +206,142 @@ def print_report(failed, skipped, succeeded):
         print("FAILED:")
         for (r, msg) in failed:
             print("\t%s: %s" % (r, msg))
+            print_tail((tails or {}).get(r))
+    if len(cancelled) > 0:
+        print("CANCELLED:")
+        for (r, msg) in cancelled:
+            print("\t%s: %s" % (r, msg))
     if len(succeeded) > 0:
         print("SUCCEEDED:")
         for r in succeeded:
             print("\t%s" % r)
     print("===============================================")
+    print_timings(timings)
+
+
+def build(base, r, branch, match, replace, message, uworld, mworld, hub,
+          reset, manifest=None, settings=None):
+    if uworld or mworld:
+        u = Updater(base, r)
+    else:
+        u = Upgrader(base, r, branch, match, replace, message, hub, manifest)
+    # before the steps are built, as eg. ve_store adds some
+    configure(u, settings or {})
+    if uworld:
+        return u, u.upgrade_steps(reset=reset)
+    if mworld:
+        return u, u.make_steps(reset=reset)
+    return u, u.upgrade_steps(reset=reset)
+
+
+async def run_all(work, jobs):
+    # False if a Ctrl-C cut it short
+    try:
+        await gather_bounded(
+            [u.run_steps_async(steps) for (u, steps) in work], jobs)
+    except asyncio.CancelledError:
+        cancel_unstarted([u for (u, steps) in work])
+        return False
+    return True
+
+
+def dry_run(base, names, match, replace, manifest=None):
+    # reads the current checkouts; nothing is pulled or changed
+    u = Upgrader(base, None, None, match, replace, None, None, manifest)
+    replacement = u.replacement()
+    changed = 0
+    for r in names:
+        text = read(os.path.join(base, r, "requirements.txt")) or ""
+        changes = replacement.preview(text)
+        if not changes:
+            continue
+        changed += 1
+        print("%s:" % r)
+        for (old, new) in changes:
+            print("\t- %s" % old)
+            print("\t+ %s" % new)
+    print("===============================================")
+    print("would upgrade: %d of %d" % (changed, len(names)))
 
 
 def main(base, repos, branch, match, replace, message, uworld, mworld, hub,
-         reset):
+         reset, jobs=1, lanes=None, dry=False, where=None, index=None,
+         index_ref="origin/master", manifest=None, wheelhouse=None,
+         offline=False, ve_store=None, incremental=False, result_cache=None,
+         force=False, worktrees=None, mirrors=None, remote=REMOTE,
+         journal=None, resume=False, rerun_failed=False, report=None,
+         trace=None, logs=None, live=False, tail=20, step_timeout=None,
+         run_timeout=None, auto_timeouts=False):
     f = open(repos)
+    names = [line.strip() for line in f]
+    if where:
+        names = select_repos(base, names, where, index, index_ref)
+    if journal:
+        journal = Journal(journal, resume)
+        if rerun_failed:
+            names = journal.failed(names)
+    if dry and not (uworld or mworld):
+        dry_run(base, names, match, replace, manifest)
+        return
     failed = []
     skipped = []
     succeeded = []
-    for line in f:
-        r = line.strip()
-        if uworld:
-            u = Updater(base, r)
-            u.upgrade(reset=reset)
-        elif mworld:
-            u = Updater(base, r)
-            u.make(reset=reset)
-        else:
-            u = Upgrader(base, r, branch, match, replace, message, hub)
-            u.upgrade(reset=reset)
+    cancelled = []
+    house = None
+    env = None
+    if wheelhouse:
+        extra = [r for (m, r) in manifest] if manifest else [replace or ""]
+        (house, env) = start_wheelhouse(
+            wheelhouse, base, names, index, index_ref, extra, offline)
+    settings = {
+        "lanes": Lanes(lanes),
+        "env": env,
+        "ve_store": VirtualenvStore(ve_store) if ve_store else None,
+        "incremental": incremental,
+        "result_cache": (ResultCache(result_cache, force)
+                         if result_cache else None),
+        "worktrees": worktrees,
+        "remote": remote,
+        "mirrors": MirrorCache(mirrors, remote) if mirrors else None,
+        "journal": journal,
+        "report": Report(report) if report else None,
+        "trace": ChromeTrace(trace) if trace else None,
+        "logs": LogCapture(logs, live, tail) if logs or live else None,
+        "timeouts": (Timeouts(step_timeout, run_timeout, journal,
+                              auto_timeouts)
+                     if step_timeout or run_timeout or auto_timeouts
+                     else None),
+    }
+    if settings["mirrors"] is not None:
+        for r in settings["mirrors"].update_all(names, jobs):
+            print("could not mirror %s" % r)
+    work = [build(base, r, branch, match, replace, message, uworld, mworld,
+                  hub, reset, manifest, settings) for r in names]
+    finished = run_sync(run_all(work, jobs))
+    for (u, steps) in work:
         if u.status == "failed":
-            failed.append((r, u.log))
+            failed.append((u.repo, u.log))
         elif u.status == "skipped":
-            skipped.append(r)
+            skipped.append(u.repo)
+        elif u.status == "cancelled":
+            cancelled.append((u.repo, u.log))
         else:
-            succeeded.append(r)
-    print_report(failed, skipped, succeeded)
+            succeeded.append(u.repo)
+    if house is not None:
+        house.close()
+    if journal is not None:
+        journal.close()
+    timings = [t for (u, steps) in work for t in u.timings]
+    tails = dict((u.repo, u.tail) for (u, steps) in work)
+    print_report(failed, skipped, succeeded, timings, tails, cancelled)
+    if settings["report"] is not None:
+        settings["report"].summary(
+            failed, skipped, succeeded, timings, cancelled)
+        settings["report"].close()
+    if settings["trace"] is not None:
+        settings["trace"].close()
+    if not finished:
+        return 130
 
 
 if __name__ == "__main__":
@@ -209,11 +354,107 @@ if __name__ == "__main__":
     parser.add_argument('--replace', help='replacement')
     parser.add_argument('--reset', help='do a reset --hard')
     parser.add_argument('--message', help='commit and PR message')
+    parser.add_argument('--manifest',
+                        help='file of "match replace" pairs to apply '
+                        'together, instead of --match/--replace')
     parser.add_argument('--uworld', help='just update everything')
     parser.add_argument('--mworld', help='make world')
     parser.add_argument('--hub', help='path to hub',
                         default='/usr/local/bin/hub')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of repositories to work on at once')
+    parser.add_argument('--network-jobs', type=int,
+                        help='limit on concurrent pulls')
+    parser.add_argument('--cpu-jobs', type=int,
+                        help='limit on concurrent builds')
+    parser.add_argument('--publish-jobs', type=int,
+                        help='limit on concurrent pushes and pull requests')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only show what --match/--replace would change')
+    parser.add_argument('--where',
+                        help="only repos whose pins match, eg. "
+                        "'django<2.2.13'")
+    parser.add_argument('--index',
+                        help='file to keep the requirements index in')
+    parser.add_argument('--index-ref', default='origin/master',
+                        help='git ref to index requirements at')
+    parser.add_argument('--wheelhouse',
+                        help='directory for a shared cache of every pinned '
+                        'package, served to the builds as their index')
+    parser.add_argument('--offline', action='store_true',
+                        help='with --wheelhouse, do not fall back to PyPI')
+    parser.add_argument('--ve-store',
+                        help='directory to build each distinct virtualenv '
+                        'once in, to be linked into the repos')
+    parser.add_argument('--incremental', action='store_true',
+                        help='install just the upgraded packages into the '
+                        'existing ve instead of rebuilding it')
+    parser.add_argument('--result-cache',
+                        help='directory to remember successful builds in, '
+                        'so an unchanged tree is not built again')
+    parser.add_argument('--force', action='store_true',
+                        help='build even if --result-cache has a success')
+    parser.add_argument('--worktrees',
+                        help='do upgrades in throwaway git worktrees under '
+                        'this directory, leaving the checkouts alone')
+    parser.add_argument('--mirrors',
+                        help='directory of bare mirrors to fetch from, '
+                        'updated once at the start of the run')
+    parser.add_argument('--remote', default=REMOTE,
+                        help='git url for a repo, with {} for its name')
+    parser.add_argument('--journal',
+                        help='file to log each repo\'s completed steps to '
+                        'as they happen')
+    parser.add_argument('--resume', action='store_true',
+                        help='carry on from the steps --journal says were '
+                        'done, instead of starting every repo over')
+    parser.add_argument('--rerun-failed', action='store_true',
+                        help='only the repos --journal says failed, were '
+                        'cut off or never ran last time')
+    parser.add_argument('--report',
+                        help='file to write a JSON line to for each step '
+                        'and repo as it finishes, and a summary at the end')
+    parser.add_argument('--trace',
+                        help='file to write the run to as Chrome trace '
+                        'events, for chrome://tracing or Perfetto')
+    parser.add_argument('--logs',
+                        help='directory to capture each repo\'s command '
+                        'output to, as <repo>.log, instead of the terminal')
+    parser.add_argument('--live', action='store_true',
+                        help='stream command output to the terminal, each '
+                        'line prefixed with its [repo]')
+    parser.add_argument('--tail', type=int, default=20,
+                        help='lines of captured output to show for a '
+                        'failed step')
+    parser.add_argument('--step-timeout', type=float,
+                        help='seconds a step gets before its commands are '
+                        'killed')
+    parser.add_argument('--run-timeout', type=float,
+                        help='seconds the whole run gets before what\'s '
+                        'still going is killed')
+    parser.add_argument('--auto-timeouts', action='store_true',
+                        help='time each step out at a multiple of how long '
+                        'it has taken that repo, going by --journal')
     args = parser.parse_args()
-    main(args.base, args.repos, args.branch, args.match,
-         args.replace, args.message, args.uworld, args.mworld, args.hub,
-         args.reset)
+    if (args.resume or args.rerun_failed) and not args.journal:
+        parser.error('--resume and --rerun-failed need --journal')
+    if args.auto_timeouts and not args.journal:
+        parser.error('--auto-timeouts needs --journal')
+    manifest = None
+    if args.manifest:
+        try:
+            manifest = load_manifest(args.manifest)
+        except (IOError, ValueError) as e:
+            parser.error(str(e))
+    lanes = {NETWORK: args.network_jobs, CPU: args.cpu_jobs,
+             PUBLISH: args.publish_jobs}
+    sys.exit(main(
+        args.base, args.repos, args.branch, args.match, args.replace,
+        args.message, args.uworld, args.mworld, args.hub, args.reset,
+        args.jobs, lanes, args.dry_run, args.where, args.index,
+        args.index_ref, manifest, args.wheelhouse, args.offline,
+        args.ve_store, args.incremental, args.result_cache, args.force,
+        args.worktrees, args.mirrors, args.remote, args.journal,
+        args.resume, args.rerun_failed, args.report, args.trace, args.logs,
+        args.live, args.tail, args.step_timeout, args.run_timeout,
+        args.auto_timeouts))
@@ -0,0 +1,226 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+from functools import lru_cache
+
+from engine import call, output, in_thread
+from reqindex import PIN, normalize, parse_pins, version_key
+
+# the repos' Makefiles call their virtualenv's sentinel file this
+SENTINAL = 'sentinal'
+KEY_FILE = '.upgrayedd-key'
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def relocate(src, dst, old, new):
+    # scripts' shebangs, activate and .pth files name the directory the
+    # env was built in; those get their own rewritten copy instead of a
+    # link
+    if os.path.getsize(src) > 1024 * 1024:
+        return
+    with open(src, 'rb') as f:
+        content = f.read()
+    if old not in content:
+        return
+    os.remove(dst)
+    with open(dst, 'wb') as f:
+        f.write(content.replace(old, new))
+    shutil.copystat(src, dst)
+
+
+def touch(path):
+    with open(path, 'a'):
+        os.utime(path, None)
+
+
+@lru_cache(maxsize=None)
+def interpreter_id(python):
+    return subprocess.check_output(
+        [python, '-c',
+         'import sys; print(sys.executable); print(sys.version)'])
+
+
+class VirtualenvStore(object):
+    # virtualenvs built once per distinct (requirements.txt, interpreter)
+    # by the repo's own Makefile, then cloned into each repo's ve/ with
+    # hard links, so that `make` only has to run the tests
+
+    def __init__(self, path, python='python'):
+        self.path = os.path.abspath(path)
+        self.python = python
+        self.locks = {}
+
+    def key(self, requirements_path):
+        # None for a repo without a requirements.txt, which the store
+        # has nothing to go on for
+        if not os.path.exists(requirements_path):
+            return None
+        with open(requirements_path, 'rb') as f:
+            requirements = f.read()
+        digest = hashlib.sha256(interpreter_id(self.python))
+        digest.update(b'\0' + requirements)
+        return digest.hexdigest()
+
+    def env_path(self, key):
+        return os.path.join(self.path, key)
+
+    def built(self, key):
+        return os.path.exists(os.path.join(self.env_path(key), SENTINAL))
+
+    async def build(self, repo_path, key, env=None):
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+        async with self.locks[key]:
+            if self.built(key):
+                return 0
+            ve = self.env_path(key)
+            ret = await call(
+                ['make', 'VE=' + ve, os.path.join(ve, SENTINAL)],
+                cwd=repo_path, env=env)
+            if ret:
+                shutil.rmtree(ve, ignore_errors=True)
+            return ret
+
+    def materialize(self, key, dest):
+        src = self.env_path(key)
+        old = src.encode()
+        new = os.path.abspath(dest).encode()
+        if os.path.lexists(dest):
+            shutil.rmtree(dest)
+        for (directory, dirs, files) in os.walk(src):
+            target = os.path.join(dest, os.path.relpath(directory, src))
+            os.makedirs(target, exist_ok=True)
+            for name in dirs + files:
+                s = os.path.join(directory, name)
+                d = os.path.join(target, name)
+                if os.path.islink(s):
+                    link = os.readlink(s).encode()
+                    os.symlink(link.replace(old, new).decode(), d)
+                elif name in files:
+                    link_or_copy(s, d)
+                    if (os.path.basename(directory) == 'bin' or
+                            name.endswith('.pth')):
+                        relocate(s, d, old, new)
+            # don't descend into symlinked directories
+            dirs[:] = [n for n in dirs
+                       if not os.path.islink(os.path.join(directory, n))]
+        # a sentinel of its own, as touch() below must not reach the store
+        sentinal = os.path.join(dest, SENTINAL)
+        os.remove(sentinal)
+        touch(sentinal)
+        with open(os.path.join(dest, KEY_FILE), 'w') as f:
+            f.write(key)
+
+    def current(self, dest, key):
+        try:
+            with open(os.path.join(dest, KEY_FILE)) as f:
+                return f.read() == key
+        except IOError:
+            return False
+
+    async def provide(self, repo_path, requirements_path, env=None):
+        # returns non-zero if the env couldn't be built; without a key,
+        # the ve is left for make to build as usual
+        key = self.key(requirements_path)
+        if key is None:
+            return 0
+        dest = os.path.join(repo_path, 've')
+        if not self.current(dest, key):
+            ret = await self.build(repo_path, key, env)
+            if ret:
+                return ret
+            # a big ve is a lot of links to make, so not on the loop
+            await in_thread(self.materialize, key, dest)
+        # so make sees the ve as newer than requirements.txt, even if a
+        # checkout has just touched it
+        touch(os.path.join(dest, SENTINAL))
+        return 0
+
+
+def removed_pins(changes):
+    # (old, new) requirements lines -> the names of packages that are no
+    # longer pinned at all
+    old = {}
+    new = {}
+    for (o, n) in changes:
+        old.update(parse_pins(o))
+        new.update(parse_pins(n))
+    return sorted(set(old) - set(new))
+
+
+def out_of_date(text, installed):
+    # the pin lines of a requirements.txt that what's installed doesn't
+    # match
+    lines = []
+    for line in text.splitlines():
+        m = PIN.match(line)
+        if m is None:
+            continue
+        version = installed.get(normalize(m.group(1)))
+        if version is None or version_key(version) != version_key(
+                m.group(3)):
+            lines.append(line.strip())
+    return lines
+
+
+async def freeze(pip, repo_path, env=None):
+    # name -> version of what's installed in a ve, or None
+    (ret, out) = await output(
+        [pip, 'freeze', '--all'], cwd=repo_path, env=env)
+    if ret:
+        return None
+    return parse_pins(out.decode('utf-8', 'replace'))
+
+
+async def update_in_place(repo_path, requirements_path, changes, env=None):
+    # install just the pins the existing ve doesn't match, going by `pip
+    # freeze`, so whatever a pull brought in is caught as well as the
+    # upgrade's own changes, and mark it up to date rather than letting
+    # the Makefile rebuild it from scratch. anything going wrong, or
+    # nothing to do, leaves the sentinel as it was (or removes it), so
+    # make still decides about the full rebuild.
+    # absolute, as pip runs in the repo rather than wherever we are
+    ve = os.path.abspath(os.path.join(repo_path, 've'))
+    sentinal = os.path.join(ve, SENTINAL)
+    pip = os.path.join(ve, 'bin', 'pip')
+    if not (os.path.exists(sentinal) and os.path.exists(pip)):
+        return 0
+    installed = await freeze(pip, repo_path, env)
+    if installed is None:
+        return 0
+    with open(requirements_path) as f:
+        install = out_of_date(f.read(), installed)
+    removed = [name for name in removed_pins(changes) if name in installed]
+    if not install and not removed:
+        return 0
+    if removed:
+        await call([pip, 'uninstall', '--yes'] + removed,
+                   cwd=repo_path, env=env)
+    if install:
+        (fd, path) = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(install) + '\n')
+        try:
+            ret = await call([pip, 'install', '--no-deps', '-r', path],
+                             cwd=repo_path, env=env)
+        finally:
+            os.remove(path)
+        if ret:
+            os.remove(sentinal)
+            return 0
+    touch(sentinal)
+    # if anything else in the Makefile's sentinel rule is out of date,
+    # make will rebuild the ve as usual
+    if await call(['make', '-q', os.path.join('ve', SENTINAL)],
+                  cwd=repo_path, env=env):
+        print('virtualenv still out of date, make will rebuild it')
+    return 0
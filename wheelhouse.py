@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+from functools import partial
+from html import escape
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from engine import run_sync, gather_bounded, call
+from reqindex import normalize, parse_pins, RequirementsIndex
+
+PYPI = 'https://pypi.org/simple/'
+ARCHIVE = re.compile(r'\.(tar\.gz|tar\.bz2|tgz|zip)$')
+
+
+def project_name(filename):
+    if filename.endswith('.whl'):
+        return normalize(filename.split('-')[0])
+    return normalize(ARCHIVE.sub('', filename).rsplit('-', 1)[0])
+
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Wheelhouse(object):
+    # a content-addressed store of the distributions pinned across all the
+    # repos (files/<sha256>/<filename>), with a PEP 503 simple index over
+    # it (simple/<project>/) that repo builds can be pointed at.
+
+    def __init__(self, path, python=sys.executable):
+        self.path = os.path.abspath(path)
+        self.python = python
+        self.manifest_path = os.path.join(self.path, 'pins.json')
+        self.pins = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.pins = json.load(f)
+        self.server = None
+
+    def add(self, filename):
+        digest = sha256(filename)
+        name = os.path.basename(filename)
+        directory = os.path.join(self.path, 'files', digest[:2], digest)
+        if not os.path.exists(os.path.join(directory, name)):
+            os.makedirs(directory, exist_ok=True)
+            shutil.move(filename, os.path.join(directory, name))
+        return digest
+
+    def download(self, specs):
+        return run_sync(self.download_async(specs))
+
+    async def download_async(self, specs):
+        # returns whether pip managed to download all of specs
+        tmp = tempfile.mkdtemp(dir=self.path)
+        try:
+            ret = await call(
+                [self.python, '-m', 'pip', 'download', '--no-deps',
+                 '--quiet', '--dest', tmp] + specs)
+            for name in os.listdir(tmp):
+                self.add(os.path.join(tmp, name))
+        finally:
+            shutil.rmtree(tmp)
+        if not ret:
+            for spec in specs:
+                self.pins[spec] = True
+        return not ret
+
+    def fetch(self, pins, jobs=4):
+        # pins is (name, version) pairs; ones fetched on an earlier run
+        # are skipped. one pip for everything, then one per pin if any
+        # of them can't be found.
+        os.makedirs(self.path, exist_ok=True)
+        specs = sorted(set('%s==%s' % (normalize(n), v) for (n, v) in pins))
+        missing = [s for s in specs if s not in self.pins]
+        if missing and not self.download(missing):
+            run_sync(gather_bounded(
+                [self.download_async([s]) for s in missing], jobs))
+        with open(self.manifest_path, 'w') as f:
+            json.dump(self.pins, f, indent=1, sort_keys=True)
+        self.write_index()
+
+    def write_index(self):
+        projects = {}
+        files = os.path.join(self.path, 'files')
+        for (directory, _, names) in os.walk(files):
+            for name in names:
+                digest = os.path.basename(directory)
+                projects.setdefault(project_name(name), []).append(
+                    '<a href="../../files/%s/%s/%s#sha256=%s">%s</a><br>' % (
+                        digest[:2], digest, escape(name), digest,
+                        escape(name)))
+
+        simple = os.path.join(self.path, 'simple')
+        links = []
+        for (project, anchors) in sorted(projects.items()):
+            os.makedirs(os.path.join(simple, project), exist_ok=True)
+            with open(os.path.join(simple, project, 'index.html'), 'w') as f:
+                f.write('<!DOCTYPE html>\n<html><body>\n%s\n</body></html>\n'
+                        % '\n'.join(sorted(anchors)))
+            links.append('<a href="%s/">%s</a><br>' % (project, project))
+        os.makedirs(simple, exist_ok=True)
+        with open(os.path.join(simple, 'index.html'), 'w') as f:
+            f.write('<!DOCTYPE html>\n<html><body>\n%s\n</body></html>\n'
+                    % '\n'.join(links))
+
+    def serve(self, host='127.0.0.1', port=0):
+        handler = partial(QuietHandler, directory=self.path)
+        self.server = Server((host, port), handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://%s:%d/simple/' % (host, self.server.server_port)
+
+    def environ(self, url, offline=False):
+        # for the children's environment. unless offline, pypi stays
+        # available for anything that isn't in the wheelhouse.
+        env = {'PIP_INDEX_URL': url}
+        if not offline:
+            env['PIP_EXTRA_INDEX_URL'] = PYPI
+        return env
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def start_wheelhouse(path, base, names, index=None, ref='origin/master',
+                     extra=(), offline=False, jobs=4):
+    # fetch every pin across the repos (plus the `extra` requirement
+    # lines, eg. the versions being upgraded to), serve the wheelhouse
+    # and return it along with the environment for the builds
+    requirements_index = RequirementsIndex(index, ref)
+    requirements_index.refresh(base, names)
+    requirements_index.save()
+    pins = [(name, version)
+            for (name, versions) in requirements_index.packages().items()
+            for version in versions]
+    for line in extra:
+        pins.extend((n, v) for (n, v) in parse_pins(line).items()
+                    if '$' not in v)
+    wheelhouse = Wheelhouse(path)
+    wheelhouse.fetch(pins, jobs)
+    url = wheelhouse.serve()
+    return (wheelhouse, wheelhouse.environ(url, offline))